@@ -5,3 +5,12 @@ class DbConfig(AppConfig):
     name = 'db'
     verbose_name = "QUOREM DB"
     default_auto_field = "django.db.models.BigAutoField"
+
+    def ready(self):
+        # Every model is loaded by now, so freeze the Object, Value and Data
+        # subclasses into their registries (see db/registry.py)
+        from .models.object import Object
+        from .models import Value, Data
+        Object.type_registry()
+        Value.type_registry()
+        Data.type_registry()
@@ -3,15 +3,23 @@ import yaml
 import re
 import os
 import sys
+import io
+import hashlib
+import json
+import importlib.metadata
 import time
-import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import defaultdict, OrderedDict
 import h5py as h5
 import ete3
-import biom
+import skbio
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.files import File
 from django.conf import settings
+from django.apps import apps
+from django.db import connections, transaction
 
 from celery import current_app
 from scipy.sparse import coo_matrix, csr_matrix
@@ -23,77 +31,131 @@ from .models.sample import Sample
 from .models.feature import Feature
 from .models.step import Step
 from .models.file import UploadFile
+from .ingest import BulkIngester
 
 def scalar_constructor(loader, node):
     value = loader.construct_scalar(node)
     return value
 
-yaml.add_constructor('!ref', scalar_constructor)
-yaml.add_constructor('!no-provenance', scalar_constructor)
-yaml.add_constructor('!color', scalar_constructor)
-yaml.add_constructor('!cite', scalar_constructor)
-yaml.add_constructor('!metadata', scalar_constructor)
+# The libyaml bindings are much faster on deep provenance, so use them when they're available
+ProvenanceLoader = getattr(yaml, "CLoader", yaml.Loader)
 
-def base_uuid(filename):
-    regex = re.compile("[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-" \
-                       "[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}")
-    return regex.match(filename)[0]
+for tag in ['!ref', '!no-provenance', '!color', '!cite', '!metadata']:
+    yaml.add_constructor(tag, scalar_constructor)
+    yaml.add_constructor(tag, scalar_constructor, Loader=ProvenanceLoader)
 
-def qiime2_default_args(plugin_str, func_str):
-    import qiime2
-    pm = qiime2.sdk.PluginManager()
-    if func_str in pm.plugins[plugin_str].methods:
-        params = pm.plugins[plugin_str].methods[func_str].signature.parameters
-        desc = pm.plugins[plugin_str].methods[func_str].description
-    elif func_str in pm.plugins[plugin_str].visualizers:
-        params = pm.plugins[plugin_str].visualizers[func_str].signature.parameters
-        desc = pm.plugins[plugin_str].visualizers[func_str].description
-    elif func_str in pm.plugins[plugin_str].pipelines:
-        params = pm.plugins[plugin_str].pipelines[func_str].signature.parameters
-        desc = pm.plugins[plugin_str].pipelines[func_str].description
-    else:
-        params = {}
-        desc = "No description found"
-    step_name = plugin_str + "__" + func_str
-    for param in params:
-        yield {"value_data": params[param].default,
-               "value_name": param,
-               "value_type": "parameter",
-               "step_name": step_name,
-               "value_object": "step"}
-    yield {"value_data": desc,
-           "value_name": "from_qiime2",
-           "value_type": "description",
-           "step_name": step_name,
-           "value_object": "step"}
-
-def qiime2_steps():
+uuid_regex = "[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-" \
+             "[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}"
+uuid_pattern = re.compile(uuid_regex)
+# Matches the action.yaml and metadata.yaml of every upstream artifact in one pass over the infolist
+provenance_pattern = re.compile("/artifacts/(%s)/(action/action\.yaml|metadata\.yaml)$" % (uuid_regex,))
+fastq_pattern = re.compile(".*_S.*_L001_R[12]_001.fastq.gz")
+fastq_direction_patterns = {num: re.compile('.*_S.*_L001_R%d_001.fastq.gz'%(num,)) for num in [1, 2]}
+
+def base_uuid(filename):
+    return uuid_pattern.match(filename)[0]
+
+# Bump this when the layout of the snapshot changes, so stale snapshots get rebuilt
+QIIME2_SNAPSHOT_FORMAT = 1
+
+def qiime2_plugin_versions():
+    # Read straight from the installed package metadata, so it's cheap and doesn't load any plugins
+    versions = {}
+    for dist in importlib.metadata.distributions():
+        name = dist.metadata["Name"]
+        if name and (name.lower().startswith("q2") or (name.lower() == "qiime2")):
+            versions[name] = dist.version
+    return versions
+
+def qiime2_snapshot_path(versions):
+    key = hashlib.sha256(json.dumps(versions, sort_keys=True).encode()).hexdigest()[:16]
+    directory = getattr(settings, "QIIME2_SNAPSHOT_DIR", os.path.join(settings.BASE_DIR, "qiime2_snapshots"))
+    return os.path.join(directory, "qiime2_%s.json" % (key,))
+
+def qiime2_snapshot(refresh=False):
+    # Introspecting the PluginManager is slow, so we do it once per set of
+    # installed plugin versions and keep the Steps and their default parameters as JSON
+    versions = qiime2_plugin_versions()
+    path = qiime2_snapshot_path(versions)
+    if os.path.exists(path) and not refresh:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+        if (snapshot.get("format") == QIIME2_SNAPSHOT_FORMAT) and (snapshot.get("versions") == versions):
+            return snapshot
     import qiime2
     pm = qiime2.sdk.PluginManager()
+    steps = OrderedDict()
     for ps in pm.plugins:
-        for method in pm.plugins[ps].methods:
-            yield {"step_name": ps+"__"+method}
-        for viz in pm.plugins[ps].visualizers:
-            yield {"step_name": ps+"__"+viz}
-        for pipe in pm.plugins[ps].pipelines:
-            yield {"step_name": ps+"__"+pipe}
-
-def mine_qiime2():
-    import qiime2
-    for step_kwargs in qiime2_steps():
-        obj_ids, create_kwargs, update_kwargs = Object._parse_kwargs(**step_kwargs)
-        step_ids = obj_ids["steps"]
-        step = Step.get_or_create(name=step_ids[0]).get() # NOTE: I don't pass create_kwargs here, so if qiime2_steps() feeds it anything detailed it'll get lost
-        if "__" in step.name:
-            plugin, cmd = step.name.split("__")
-            for rec in qiime2_default_args(plugin, cmd):
-                if type(rec["value_data"]) == qiime2.core.type.signature.__NoValueMeta:
+        plugin = pm.plugins[ps]
+        # Methods win over visualizers and pipelines of the same name
+        for actions in [plugin.methods, plugin.visualizers, plugin.pipelines]:
+            for func_str in actions:
+                step_name = ps + "__" + func_str
+                if step_name in steps:
                     continue
-                if rec["value_data"]:
-                    Value.get_or_create(**Value._parse_kwargs(**rec))
-
-def ingest_artifact(artifact_file_or_path, analysis):
-    artifactiterator = ArtifactIterator(artifact_file_or_path)
+                params = OrderedDict()
+                for param, spec in actions[func_str].signature.parameters.items():
+                    if type(spec.default) == qiime2.core.type.signature.__NoValueMeta:
+                        continue
+                    if spec.default:
+                        params[param] = spec.default
+                steps[step_name] = {"description": actions[func_str].description,
+                                    "parameters": params}
+    snapshot = {"format": QIIME2_SNAPSHOT_FORMAT,
+                "versions": versions,
+                "steps": steps}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename, so a concurrent initialize never reads half a snapshot
+    # Defaults that JSON can't hold are stored as strings, which is how they'd be cast anyway
+    with open(path + ".tmp", "w") as fp:
+        json.dump(snapshot, fp, default=str)
+    os.replace(path + ".tmp", path)
+    # Hand back exactly what a later run would read from disk
+    return json.loads(json.dumps(snapshot, default=str))
+
+def load_qiime2_snapshot(snapshot, batch_size=5000):
+    # Creates every Step and its default Parameters and description in a handful of batched statements
+    Parameter = Value.get_value_types(type_name="parameter")
+    Description = Value.get_value_types(type_name="description")
+    with transaction.atomic():
+        ingester = BulkIngester(batch_size=batch_size)
+        ingester.init_objects([{"step_name": step_name} for step_name in snapshot["steps"]])
+        step_pks = ingester.resolve(Step, snapshot["steps"].keys())
+        records = []
+        for step_name, step in snapshot["steps"].items():
+            for name, default in step["parameters"].items():
+                records.append({"name": name, "data": default, "value_type": Parameter, "steps": [step_pks[step_name]]})
+            records.append({"name": "from_qiime2", "data": step["description"], "value_type": Description, "steps": [step_pks[step_name]]})
+        # Anything a Step already has a Value for, under that signature, is left alone
+        # Step-level default Parameters are bulk safe (see Parameter.bulk_safe)
+        Value.bulk_create(records, skip_existing=True, batch_size=batch_size)
+    Object.bump_provenance_version({Step: step_pks.values()})
+
+def mine_qiime2(refresh=False):
+    print("Reading QIIME2 plugin snapshot")
+    snapshot = qiime2_snapshot(refresh=refresh)
+    print("Loading %d Steps" % (len(snapshot["steps"]),))
+    load_qiime2_snapshot(snapshot)
+
+def ingest_artifact(artifact_file_or_path, analysis, bulk=True, concurrent=False, upload_file=None):
+    # With an upload_file, the ingest commits in batches and can resume from its last checkpoint
+    # Batches are only the same on retry if we skip the same provenance as the
+    # first attempt, so that comes from the checkpoint rather than the database
+    skip = None
+    if (upload_file is not None) and upload_file.ingest_phase and (upload_file.ingest_skip is not None):
+        skip = set(upload_file.ingest_skip)
+    artifactiterator = ArtifactIterator(artifact_file_or_path, skip_ingested=skip is None)
+    if skip is not None:
+        artifactiterator.ingested = skip
+    elif upload_file is not None:
+        upload_file.ingest_skip = sorted(artifactiterator.ingested)
+    if bulk:
+        ingester = BulkIngester(create_kwargs={"results": {"analysis": analysis}},
+                                concurrent=concurrent, upload_file=upload_file)
+        ingester.ingest(artifactiterator)
+        artifactiterator.record_provenance()
+        return artifactiterator.base_uuid
+    # Per-record fallback
     # Cache
     objects = {Obj.plural_name: {} for Obj in Object.get_object_types()}
     # Create
@@ -139,9 +201,12 @@ def ingest_artifact(artifact_file_or_path, analysis):
             print(kwargs)
             print(value_kwargs)
             print(e)
+    artifactiterator.record_provenance()
     return artifactiterator.base_uuid
 
-def ingest_artifact_directory(directory, analysis, userprofile, sleep=1):
+def ingest_artifact_directory(directory, analysis, userprofile):
+    # Concurrent ingests guard what they create (see BulkIngester.concurrent), so
+    # every file can be sent at once and the celery workers are the pool
     directory = os.path.relpath(directory, settings.BASE_DIR)
     prev_dir = os.getcwd()
     os.chdir(settings.BASE_DIR +"/"+ directory)
@@ -152,12 +217,43 @@ def ingest_artifact_directory(directory, analysis, userprofile, sleep=1):
             upf.save()
             current_app.send_task('db.tasks.react_to_file', (upf.pk,),
                       kwargs={'analysis_pk': analysis.pk})
-        # Give this file a headstart to process in a concurrency scenario
-            time.sleep(sleep)
     os.chdir(prev_dir)
 
+def _ingest_artifact_worker(path, analysis_pk):
+    # Runs in a pool process, so it looks up its own Analysis on its own connection
+    Analysis = apps.get_model("db.Analysis")
+    start_time = time.time()
+    try:
+        # Other pool workers are ingesting alongside us, so lock what we create
+        uuid = ingest_artifact(path, Analysis.objects.get(pk=analysis_pk), concurrent=True)
+        return (path, uuid, time.time() - start_time, None)
+    except Exception as e:
+        return (path, None, time.time() - start_time, e)
+
+def ingest_artifacts(paths, analysis, workers=4):
+    # Ingests artifacts in parallel in a pool of worker processes
+    # Returns a list of (path, result uuid, seconds, exception) tuples in the order finished
+    # Anything that fails in parallel (e.g., Postgres breaking a deadlock between
+    # two ingests creating the same things in opposite orders) is retried
+    # serially at the end, once it has the database to itself
+    # Forked workers can't share our database connection, they open their own
+    connections.close_all()
+    finished = []
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(_ingest_artifact_worker, path, analysis.pk) for path in paths]
+        for future in as_completed(futures):
+            path, uuid, seconds, error = future.result()
+            print("Ingested %s in %.1fs" % (path, seconds) if error is None else "Failed to ingest %s, will retry: %s" % (path, error))
+            finished.append((path, uuid, seconds, error))
+    retries = [path for path, uuid, seconds, error in finished if error is not None]
+    finished = [x for x in finished if x[3] is None]
+    for path in retries:
+        finished.append(_ingest_artifact_worker(path, analysis.pk))
+    return finished
+
 class ArtifactIterator:
-    def __init__(self, path_or_file):
+    def __init__(self, path_or_file, skip_ingested=True):
         if isinstance(path_or_file, str):
             self.filename = path_or_file
         else:
@@ -165,6 +261,9 @@ class ArtifactIterator:
         self.zfile = zipfile.ZipFile(path_or_file)
         self.infolist = self.zfile.infolist()
         self.base_uuid = base_uuid(self.infolist[0].filename)
+        self.index_provenance()
+        # Upstream provenance that an earlier artifact already put in is skipped entirely
+        self.ingested = self.ingested_provenance() if skip_ingested else set()
         for uuid, yf in self.iter_metadatayaml():
             if (yf['uuid'] == self.base_uuid):
                 self.base_format = yf["format"]
@@ -175,15 +274,38 @@ class ArtifactIterator:
         if ads:
             self.scraper = ads(self)
 
-    def iter_objects(self, update=True):
+    def chunked(self):
+        # Scrapers that can stream their records in chunks get ingested one chunk at a time
+        return hasattr(self.scraper, "iter_chunks")
+
+    def iter_chunks(self):
+        # Yields (object records, value records) tuples from a single pass over the data
+        if self.chunked():
+            for chunk in self.scraper.iter_chunks():
+                yield chunk
+
+    def observations(self):
+        # (Object, field, names, target names, index, target index) for scrapers
+        # that carry Object-Object observations as matrix coordinates
+        if hasattr(self.scraper, "observations"):
+            return self.scraper.observations()
+        return None
+
+    def iter_objects(self, update=True, scraper=True, observations=True):
+        # If observations is False, scrapers skip the per-Object observation
+        # records, since they're being linked from observations() instead
         sys.stdout.write("Iterating on objects...")
         # Yields single records of artifact contents that describe QUOR'em Objects
         for uuid, yf in self.iter_actionyaml():
+            # Already ingested provenance still has to link its samples to this artifact
+            known = uuid in self.ingested
             if 'action' not in yf:
                 raise ValueError("QIIME2 Artifact does not appear to have an action yaml")
             if 'type' not in yf['action']:
                 raise ValueError("QIIME2 Artifact does not appear to have a type")
             sys.stdout.write("Action and type identified")
+            if known and (yf['action']['type'] != 'import'):
+                continue
             if yf['action']['type'] in ['method', 'pipeline', 'visualizer']:
                 step_name = yf['action']['plugin'].split(":")[-1] +\
                                "__" + yf['action']['action']
@@ -191,37 +313,41 @@ class ArtifactIterator:
                 record = {"result_name": uuid,
                           "result_step": step_name}
                 upstream = ({x: y for x,y in 
-                               {"result_upstream.%d" % (idx,): uid.popitem()[1] 
+                               {"result_upstream.%d" % (idx,): list(uid.values())[0] 
                                 for idx, uid in enumerate(yf['action']['inputs'])}.items() 
                                 if y is not None})
                 record.update(upstream)
                 yield record
             elif yf['action']['type'] == 'import':
                 step_name = "qiime2_import"
-                yield {"step_name": step_name}
-                yield {"result_name": uuid,
-                       "result_step": step_name}
+                if not known:
+                    yield {"step_name": step_name}
+                    yield {"result_name": uuid,
+                           "result_step": step_name}
                 if 'manifest' in yf['action']:
                     for item in yf['action']['manifest']:
                         for prop, val in item.items():
                             if prop == 'name':
-                                if re.compile('.*_S.*_L001_R[12]_001.fastq.gz').match(val):
+                                if fastq_pattern.match(val):
                                     val = re.sub("_S.*_L001_R[12]_001.fastq.gz", "", val)
-                                    yield {"result_name": uuid,
-                                           "sample_name": val, 
-                                           "sample_step": step_name,
-                                           "result_sample": val,
-                                           "result_step": step_name}
+                                    if not known:
+                                        yield {"result_name": uuid,
+                                               "sample_name": val, 
+                                               "sample_step": step_name,
+                                               "result_sample": val,
+                                               "result_step": step_name}
                                     yield {"result_name": self.base_uuid,
                                            "result_sample": val}
-        if self.scraper:
+        if self.scraper and scraper:
             sys.stdout.write("Going to artifact scraper with update %s" % ("on" if update else "off",))
-            for record in self.scraper.iter_objects(update=update):
+            for record in self.scraper.iter_objects(update=(update and observations)):
                 yield record
 
-    def iter_values(self):
+    def iter_values(self, scraper=True):
         # Yields single records of artifact contents that are QUOR'em Values
         for uuid, yf in self.iter_metadatayaml():
+            if uuid in self.ingested:
+                continue
             for x in ["type", "format"]:
                 if yf[x] is not None:
                     yield {"result_name": yf['uuid'],
@@ -230,6 +356,8 @@ class ArtifactIterator:
                            "value_data": yf[x],
                            "value_object": "result"}
         for uuid, yf in self.iter_actionyaml():
+            if uuid in self.ingested:
+                continue
             if yf['action']['type'] in ['method', 'pipeline', 'visualizer']:
                 step_name = yf['action']['plugin'].split(":")[-1] + \
                                "__" + yf['action']['action']
@@ -258,7 +386,7 @@ class ArtifactIterator:
                         if "name" in item:
                             val = item["name"]
                             for direc, num in [("forward", 1), ("reverse", 2)]:
-                                if re.compile('.*_S.*_L001_R%d_001.fastq.gz'%(num,)).match(val):
+                                if fastq_direction_patterns[num].match(val):
                                     sample_name = str(re.sub("_S.*_L001_R[12]_001.fastq.gz", "", val))
                                     yield {"sample_name": sample_name,
                                             "value_object": "sample",
@@ -315,7 +443,7 @@ class ArtifactIterator:
                           "value_type": "version",
                           "data_type": "auto",
                           "value_data": version}
-        if self.scraper:
+        if self.scraper and scraper:
             for record in self.scraper.iter_values():
                 yield record
         yield {"result_name": self.base_uuid,
@@ -324,38 +452,52 @@ class ArtifactIterator:
                "value_data": "QIIME2 %s file of type %s from Step %s" % (yf["action"]["type"], self.base_type, step_name),
                "value_object": "result"}
 
-    def iter_actionyaml(self):
-        actions = ["action/action.yaml"]
+    def index_provenance(self):
+        # Scans the archive once and parses every provenance yaml once, so
+        # that all later iterations are served from memory
+        actions = [(self.base_uuid, self.base_uuid + "/provenance/action/action.yaml")]
+        metadata = [(self.base_uuid, self.base_uuid + "/metadata.yaml")]
         for fname in self.infolist:
-            regex = re.compile("[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-" \
-                               "[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}/action/action.yaml")
-            matches = regex.findall(fname.filename)
-            if len(matches) >= 1:
-                actions.append("artifacts/" + matches[0])
-        for ayaml in actions:
-            xf = self.zfile.open(self.base_uuid + "/provenance/" + ayaml)
-            yf = yaml.load(xf, Loader=yaml.Loader)
-            if ayaml == "action/action.yaml":
-                uuid = self.base_uuid
-            else:
-                uuid = ayaml.split("/")[1]
+            match = provenance_pattern.search(fname.filename)
+            if match:
+                if match.group(2) == "metadata.yaml":
+                    metadata.append((match.group(1), fname.filename))
+                else:
+                    actions.append((match.group(1), fname.filename))
+        self.action_yamls = OrderedDict()
+        # Fingerprint of each provenance node, the hash of its raw action.yaml
+        self.fingerprints = OrderedDict()
+        for uuid, path in actions:
+            raw = self.zfile.read(path)
+            self.fingerprints[uuid] = hashlib.sha256(raw).hexdigest()
+            self.action_yamls[uuid] = yaml.load(raw, Loader=ProvenanceLoader)
+        self.metadata_yamls = OrderedDict()
+        for uuid, path in metadata:
+            with self.zfile.open(path) as xf:
+                self.metadata_yamls[uuid] = yaml.load(xf, Loader=ProvenanceLoader)
+
+    def ingested_provenance(self):
+        # UUIDs of upstream Results whose action.yaml we have already ingested
+        # The artifact itself is never skipped, since its data still has to be scraped
+        Result = apps.get_model("db.Result")
+        upstream = [uuid for uuid in self.fingerprints if uuid != self.base_uuid]
+        found = Result.objects.filter(name__in=upstream).values_list("name", "provenance_hash")
+        return set([name for name, phash in found if phash == self.fingerprints[name]])
+
+    def record_provenance(self):
+        # Stamps the fingerprints on the Results once they've been ingested
+        Result = apps.get_model("db.Result")
+        results = list(Result.objects.filter(name__in=self.fingerprints.keys()))
+        for result in results:
+            result.provenance_hash = self.fingerprints[result.name]
+        Result.objects.bulk_update(results, ["provenance_hash"])
+
+    def iter_actionyaml(self):
+        for uuid, yf in self.action_yamls.items():
             yield (uuid, yf)
 
     def iter_metadatayaml(self):
-        metadata = [self.base_uuid+"/metadata.yaml"]
-        for fname in self.infolist:
-            regex = re.compile("[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-" \
-                               "[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}.*/artifacts/.*metadata.yaml")
-            matches = regex.findall(fname.filename)
-            if len(matches) >= 1:
-                metadata.append(matches[0])
-        for myaml in metadata:
-            xf = self.zfile.open(myaml)
-            yf = yaml.load(xf, Loader=yaml.Loader)
-            if myaml == self.base_uuid + "/metadata.yaml":
-                uuid = self.base_uuid
-            else:
-                uuid = myaml.split("/")[3]
+        for uuid, yf in self.metadata_yamls.items():
             yield (uuid, yf)
 
 class ArtifactDataScraper:
@@ -384,60 +526,74 @@ class ArtifactDataScraper:
 #    qiime_format = 'OrdinationDirectoryFormat'
 #
 
+def iter_fasta(fasta):
+    # Streams (label, sequence) pairs out of a binary FASTA handle in one pass,
+    # joining sequences that are wrapped over multiple lines
+    label = None
+    seq = []
+    for line in fasta:
+        line = line.decode().strip()
+        if not line:
+            continue
+        if line.startswith(">"):
+            if label is not None:
+                yield (label, "".join(seq))
+            label = line.strip(">").strip()
+            seq = []
+        else:
+            seq.append(line)
+    if label is not None:
+        yield (label, "".join(seq))
+
 class FeatureDataSequence(ArtifactDataScraper):
     qiime_format = "DNASequencesDirectoryFormat"
     qiime_type = "FeatureData[Sequence]"
+    chunk_size = 5000
 
     def __init__(self, ai):
-        self.fasta = False
         self.ai = ai
         self.uuid = ai.base_uuid
         self.data_file = self.uuid + "/data/dna-sequences.fasta"
-        self.reset_fasta()
 
-    def reset_fasta(self):
-        if self.fasta:
-            self.fasta.close()
-        self.fasta = self.ai.zfile.open(self.data_file)
+    def iter_chunks(self):
+        # Single pass over the fasta, emitting the feature registrations and
+        # representative_sequence values for chunk_size sequences at a time
+        feature_names = []
+        values = []
+        with self.ai.zfile.open(self.data_file) as fasta:
+            for feature_name, seq in iter_fasta(fasta):
+                feature_names.append(feature_name)
+                values.append({"feature_name": feature_name,
+                               "result_name": self.uuid,
+                               "value_name": "representative_sequence",
+                               "value_data": seq,
+                               "value_type": "measure",
+                               "data_type": "sequence",
+                               "value_object": "result",
+                               "value_object.1": "feature"})
+                if len(feature_names) >= self.chunk_size:
+                    yield ([self.feature_record(feature_names)], values)
+                    feature_names = []
+                    values = []
+        if feature_names:
+            yield ([self.feature_record(feature_names)], values)
+
+    def feature_record(self, feature_names):
+        record = {"result_name": self.uuid, "feature_result": self.uuid}
+        record.update({"feature_name.%d" % (idx,): feature_name for idx, feature_name in enumerate(feature_names)})
+        return record
 
     def iter_objects(self, update=True):
         # Just register the features
-        idx = 0
-        record = {"result_name": self.uuid, "feature_result": self.uuid}
-        while True:
-            line = self.fasta.readline().decode()
-            if line.startswith(">"):
-                feature_name = line.strip(">").strip()
-                record.update({"feature_name.%d" % (idx,): feature_name})
-                idx += 1
-            if line == "":
-                break
-        self.reset_fasta()
-        if len(record) == 2:
-            yield {}
-        else:
-            yield record
-        
+        for objects, values in self.iter_chunks():
+            for record in objects:
+                yield record
+
     def iter_values(self):
         print("Iterating over representative sequence values")
-        while True:
-            line = self.fasta.readline().decode()
-            if line == "":
-                break
-            # Pull out the actual sequences
-            label = line
-            feature_name = line.strip(">").strip()
-            line = self.fasta.readline().decode()
-            seq = line.strip()
-            yield {"feature_name": feature_name,
-                   "result_name": self.uuid,
-                   "value_name": "representative_sequence",
-                   "value_data": seq,
-                   "value_type": "measure",
-                   "data_type": "sequence",
-                   "value_object": "result",
-                   "value_object.1": "feature"}
-        self.reset_fasta()
+        for objects, values in self.iter_chunks():
+            for record in values:
+                yield record
 
 class Dada2DenoiseStats(ArtifactDataScraper):
     qiime_format = 'DADA2StatsDirFmt'
@@ -506,18 +662,17 @@ class BetaDiversity(ArtifactDataScraper):
                    "sample_result": self.uuid}
 
     def iter_values(self):
-        for index, row in self.tf.iterrows():
-            for col, dist in row.iteritems():
-                if index != col: # Don't store identities
-                    yield {"result_name": self.uuid,
-                           "sample_name": str(index),
-                           "sample_name.1": str(col),
-                           "value_data": dist,
-                           "data_type": "float",
-                           "value_name": "beta_diversity",
-                           "value_type": "measure",
-                           "value_object": "sample",
-                           "value_object.1": "result"}
+        # One condensed DistanceMatrixDatum instead of a Value per pair of Samples
+        dm = skbio.DistanceMatrix(self.tf.values, ids=[str(x) for x in self.tf.index])
+        record = {"result_name": self.uuid,
+                  "value_data": dm,
+                  "data_type": "distancematrix",
+                  "value_name": "beta_diversity",
+                  "value_type": "matrix",
+                  "value_object": "result",
+                  "value_object.1": "sample"}
+        record.update({"sample_name.%d" % (idx,): sample for idx, sample in enumerate(dm.ids)})
+        yield record
 
 class AlphaDiversity(ArtifactDataScraper):
     qiime_format = 'AlphaDiversityDirectoryFormat'
@@ -604,10 +759,8 @@ class FeatureTable(ArtifactDataScraper):
 
     def __init__(self, ai):
         self.uuid = ai.base_uuid
-        self.df, self.samples, self.features = self.get_data(ai)
-        for uuid, yf in ai.iter_actionyaml():
-            if uuid == self.uuid:
-                plugin = yf['action']['plugin'].split(":")[-1]
+        self.matrix, self.samples, self.features = self.get_data(ai)
+        plugin = ai.action_yamls[self.uuid]['action']['plugin'].split(":")[-1]
         if plugin in ['dada2', "deblur"]:
             self.value_name = "asv_table"
         elif plugin == "vsearch":
@@ -618,29 +771,38 @@ class FeatureTable(ArtifactDataScraper):
             self.value_name = "feature_table"
 
     def iter_objects(self, update=True):
-        feature_names = self.features.values_list("name", flat=True)
-        feature_dict = dict(self.features.values_list("pk", "name"))
         record = {"result_name": self.uuid}
-        record.update({"result_feature.%d" % (idx,): feature for idx, feature in enumerate(feature_names)})
-        record.update({"feature_name.%d" % (idx,): feature for idx, feature in enumerate(feature_names)})
+        record.update({"result_feature.%d" % (idx,): feature for idx, feature in enumerate(self.features)})
+        record.update({"feature_name.%d" % (idx,): feature for idx, feature in enumerate(self.features)})
         yield record
-        sample_names = self.samples.values_list("name", flat=True)
         record = {"result_name": self.uuid}
-        record.update({"sample_name.%d" % (idx,): sample for idx, sample in enumerate(sample_names)})
-        record.update({"result_sample.%d" % (idx,): sample for idx, sample in enumerate(sample_names)})
+        record.update({"sample_name.%d" % (idx,): sample for idx, sample in enumerate(self.samples)})
+        record.update({"result_sample.%d" % (idx,): sample for idx, sample in enumerate(self.samples)})
         yield record
         if update:
-            for sample in self.samples.all():
-                record = {"sample_name": sample.name}
-                features_present = self.df[self.df[sample.name]>0][sample.name].index.tolist()
-                record.update({"sample_feature.%d" % (idx,): feature for idx, feature in enumerate(features_present)})
+            # Columns are samples, so CSC gives us each sample's features as a slice
+            csc = self.matrix.tocsc()
+            for idx, sample in enumerate(self.samples):
+                start, end = csc.indptr[idx], csc.indptr[idx+1]
+                present = csc.indices[start:end][csc.data[start:end] > 0]
+                record = {"sample_name": sample}
+                record.update({"sample_feature.%d" % (fidx,): self.features[feature] for fidx, feature in enumerate(present)})
                 yield record
 
+    def observations(self):
+        # Nonzero coordinates of the table, for linking each Sample to the Features observed in it
+        coo = self.matrix.tocoo()
+        present = coo.data > 0
+        return (Sample, "features", self.samples, self.features, coo.col[present], coo.row[present])
+
     def iter_values(self):
         # Infer the table type if we can
         print("Table values being collected")
-        self.df.rowobj = "feature"
-        self.df.colobj = "sample"
+        table = self.matrix.tocoo()
+        table.row_names = self.features
+        table.col_names = self.samples
+        table.rowobj = "feature"
+        table.colobj = "sample"
         record = {"result_name": self.uuid,
                   "value_name": self.value_name,
                   "value_object": "result",
@@ -648,44 +810,21 @@ class FeatureTable(ArtifactDataScraper):
                   "value_object.1": "feature",
                   "value_type": "matrix",
                   "data_type": "coomatrix",
-                  "value_data": self.df}
-        record.update({"sample_name.%d" % (idx,): str(sample.name) for idx, sample in enumerate(self.samples)})
-        record.update({"feature_name.%d" % (idx,): feature.name for idx, feature in enumerate(self.features)})
-        print(record)
+                  "value_data": table}
+        record.update({"sample_name.%d" % (idx,): sample for idx, sample in enumerate(self.samples)})
+        record.update({"feature_name.%d" % (idx,): feature for idx, feature in enumerate(self.features)})
         yield record
 
     def get_data(self, ai):
+        # Reads the BIOM v2.1 CSR arrays straight out of the zip member into a
+        # scipy matrix (features x samples), with no temp file and no dense or
+        # pandas intermediate
         data_file = ai.base_uuid + "/data/feature-table.biom"
-        with tempfile.NamedTemporaryFile() as temp_file:
-            x=ai.zfile.read(data_file)
-            temp_file.write(x)
-            df = biom.load_table(temp_file.name).to_dataframe()
-            #Sparsify it with Pandas
-            df = df.astype(pd.SparseDtype("int", 0))
-            sample_ids = df.columns.tolist()
-            feature_ids = df.index.tolist()
-        # We can release the h5 file at this point: we have all we need from it
-        samples = Sample.objects.filter(name__in=sample_ids)
-        features = Feature.objects.filter(name__in=feature_ids)
-        found_samples = dict(samples.values_list("name", "pk"))
-        found_features = dict(features.values_list("name", "pk"))
-        sample_pks = {}
-        feature_pks = {}
-        for idx, sample in enumerate(sample_ids):
-            if sample not in found_samples:
-                new_samples = Sample.create(name=sample)
-                sample_pks[idx] = new_samples.first().pk
-                samples = samples | new_samples
-            else:
-                sample_pks[idx] = found_samples[sample]
-        for idx, feature in enumerate(feature_ids):
-            if feature not in found_features:
-                new_features = Feature.create(name=feature)
-                feature_pks[idx] = new_features.first().pk
-                features = features | new_features
-            else:
-                feature_pks[idx] = found_features[feature]
-        return df, samples, features
-
-
-
+        with h5.File(io.BytesIO(ai.zfile.read(data_file)), "r") as biom_file:
+            feature_ids = [x.decode() if type(x) == bytes else str(x) for x in biom_file["observation/ids"][:]]
+            sample_ids = [x.decode() if type(x) == bytes else str(x) for x in biom_file["sample/ids"][:]]
+            matrix = csr_matrix((biom_file["observation/matrix/data"][:],
+                                 biom_file["observation/matrix/indices"][:],
+                                 biom_file["observation/matrix/indptr"][:]),
+                                shape=(len(feature_ids), len(sample_ids)))
+        return matrix, sample_ids, feature_ids
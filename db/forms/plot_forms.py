@@ -16,7 +16,7 @@ from ..models import (
 
 from django.forms import ModelForm
 
-from dal import autocomplete
+from dal import autocomplete, forward
 
 ##### Plot Option Select Form
 
@@ -57,9 +57,9 @@ class TableCollapseForm(forms.Form):
 
 class PCoAPlotForm(forms.Form):
     count_matrix = forms.ModelChoiceField(queryset=Result.objects.all(),
-                                          label="Count Matrix",
+                                          label="Count or Distance Matrix",
                                           widget=autocomplete.ModelSelect2(url='result-countmatrix-autocomplete',
-                                          forward=("taxonomy_result",),
+                                          forward=("taxonomy_result", forward.Const(True, "distance_matrices")),
                                           attrs={"style": "flex-grow: 1; width: 50%", 'data-html': True, 'data-allow-clear': 'true'}))
     measures = ['euclidean', 'l2', 'l1', 'manhattan', 'cityblock', 'braycurtis', 'canberra', 'chebyshev', 'correlation', 'cosine', 'dice', 'hamming', 'jaccard', 'kulsinski', 'mahalanobis', 'matching', 'minkowski', 'rogerstanimoto', 'russellrao', 'seuclidean', 'sokalmichener', 'sokalsneath', 'sqeuclidean', 'yule', 'wminkowski', 'nan_euclidean', 'haversine']
     measure = autocomplete.Select2ListChoiceField(required=True, choice_list=measures,
@@ -0,0 +1,331 @@
+#Bulk ingestion engine shared by the artifact and spreadsheet scrapers
+# The per-record path (Obj.get_or_create/Value.get_or_create for every record
+# an iterator yields) costs thousands of single-row round trips per upload.
+# BulkIngester collects the records into per-model batches instead, resolves
+# names that already exist with one name__in query per model, and writes the
+# missing rows and M2M through-rows with bulk_create, all in one transaction
+import itertools
+from collections import defaultdict, OrderedDict
+from functools import partial
+
+from django.db import models, transaction
+
+import numpy as np
+
+from .models.object import Object
+from .models.value import Value
+from .models.data_types import DataSignature
+from .postgres import advisory_lock
+
+class BulkIngester:
+    batch_size = 5000
+    # Phases in the order they run, for resuming from an UploadFile's checkpoint
+    phases = ["objects", "update", "observations", "values", "chunks", "done"]
+    phase_messages = {"objects": "Initializing Objects",
+                      "update": "Updating Objects",
+                      "observations": "Linking observations",
+                      "values": "Putting in values",
+                      "chunks": "Ingesting scraped data in chunks"}
+
+    def __init__(self, create_kwargs=None, batch_size=None, concurrent=False, upload_file=None):
+        # create_kwargs are forced onto every new Object of that type,
+        # e.g., {"results": {"analysis": analysis}}
+        self.create_kwargs = create_kwargs if create_kwargs else {}
+        if batch_size:
+            self.batch_size = batch_size
+        # If other ingests may be running at the same time, whatever we are about
+        # to create is either inserted with ON CONFLICT against a unique column, or
+        # locked and looked up again first, so two ingests never both create it
+        self.concurrent = concurrent
+        # If we have an UploadFile, every batch commits on its own and is checkpointed
+        # against it, otherwise the whole ingest is a single transaction
+        self.upload_file = upload_file
+        # Cache of name -> pk for every Object we have resolved or created
+        self.pks = {Obj.plural_name: {} for Obj in Object.get_object_types()}
+
+    def ingest(self, iterator):
+        try:
+            self._ingest(iterator)
+        finally:
+            # Bulk writes skip Value.create and Object.update, so invalidate the
+            # cached provenance graphs of everything we touched, even if we only got partway
+            Object.bump_provenance_version({Objs: pks.values() for Objs, pks in self.pks.items()})
+
+    def _ingest(self, iterator):
+        if self.upload_file is None:
+            with transaction.atomic():
+                for phase, units in self.iter_work(iterator):
+                    print(self.phase_messages[phase])
+                    for unit in units:
+                        unit()
+            return
+        done_phase = self.upload_file.ingest_phase
+        done_batch = self.upload_file.ingest_batch
+        if done_phase == "done":
+            print("Already ingested, nothing to do")
+            return
+        for phase, units in self.iter_work(iterator):
+            if done_phase and (self.phases.index(phase) < self.phases.index(done_phase)):
+                print("Skipping %s, already committed" % (phase,))
+                continue
+            print(self.phase_messages[phase])
+            for batch, unit in enumerate(units):
+                if (phase == done_phase) and (batch < done_batch):
+                    continue
+                with transaction.atomic():
+                    unit()
+                    self.upload_file.checkpoint(phase, batch + 1)
+        self.upload_file.checkpoint("done", 0)
+
+    def iter_work(self, iterator):
+        # Yields (phase, units), where each unit is a callable that ingests one batch
+        # Iterators have to yield the same records in the same order every time,
+        # which is what lets a resumed ingest skip the batches it already committed
+        # Scrapers that stream their data in chunks are ingested one chunk at a
+        # time after everything else, so their records never all sit in memory
+        chunked = hasattr(iterator, "chunked") and iterator.chunked()
+        iter_kwargs = {"scraper": False} if chunked else {}
+        # Count matrices hand us their observations as coordinates, which we link
+        # in bulk instead of going through one record per Sample
+        observations = iterator.observations() if hasattr(iterator, "observations") else None
+        update_kwargs = dict(iter_kwargs)
+        if observations is not None:
+            update_kwargs["observations"] = False
+        yield "objects", [lambda: self.init_objects(iterator.iter_objects(update=False, **iter_kwargs))]
+        yield "update", [lambda: self.update_objects(iterator.iter_objects(**update_kwargs))]
+        if observations is not None:
+            yield "observations", [lambda: self.link_matrix(*observations)]
+        yield "values", (partial(self.ingest_values, batch) for batch in self.batches(iterator.iter_values(**iter_kwargs)))
+        if chunked:
+            yield "chunks", (partial(self.ingest_chunk, objects, values) for objects, values in iterator.iter_chunks())
+
+    def batches(self, records):
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def ingest_chunk(self, objects, values):
+        self.init_objects(objects)
+        self.update_objects(objects)
+        self.ingest_values(values)
+
+    def resolve(self, Obj, names):
+        # Returns {name: pk} for the names that exist, querying only for the ones we haven't seen
+        cache = self.pks[Obj.plural_name]
+        names = set([str(x) for x in names])
+        missing = [x for x in names if x not in cache]
+        if missing:
+            for name, pk in Obj.objects.filter(name__in=missing).values_list("name", "pk"):
+                cache.setdefault(name, pk)
+        return {x: cache[x] for x in names if x in cache}
+
+    def init_objects(self, records):
+        parsed = [Object._parse_kwargs(resolve_relations=False, **kwargs) for kwargs in records]
+        # Required relations point "up" the save order, so by the time we get to
+        # an Object type, everything it needs to be created has been flushed
+        for Obj in Object.save_order():
+            pending = OrderedDict()
+            for obj_ids, create_kwargs, update_kwargs in parsed:
+                for obj_id in obj_ids.get(Obj.plural_name, []):
+                    ckwargs = pending.setdefault(str(obj_id), {})
+                    for field, data in create_kwargs.get(Obj.plural_name, {}).items():
+                        ckwargs.setdefault(field, data)
+            if not pending:
+                continue
+            found = self.resolve(Obj, pending.keys())
+            missing = [name for name in pending if name not in found]
+            unique = Obj._meta.get_field("name").unique
+            if missing and self.concurrent and not unique:
+                # Nothing in the database stops two ingests creating the same name,
+                # so lock just the ones we're about to create, and look again in
+                # case another ingest committed them while we waited
+                advisory_lock(Obj.plural_name, missing)
+                found = self.resolve(Obj, missing)
+                missing = [name for name in missing if name not in found]
+            new_objs = [self._build(Obj, name, pending[name]) for name in missing]
+            if not new_objs:
+                continue
+            print("Creating %d %s" % (len(new_objs), Obj.plural_name))
+            if self.concurrent and unique:
+                # The unique name does the locking, anything another ingest got
+                # in first is skipped. No pks come back, so those are looked up
+                Obj.objects.bulk_create(new_objs, batch_size=self.batch_size, ignore_conflicts=True)
+                self.resolve(Obj, missing)
+                continue
+            for obj in Obj.objects.bulk_create(new_objs, batch_size=self.batch_size):
+                self.pks[Obj.plural_name][obj.name] = obj.pk
+
+    def _build(self, Obj, name, create_kwargs):
+        create_kwargs = dict(create_kwargs)
+        create_kwargs.update(self.create_kwargs.get(Obj.plural_name, {}))
+        for heading, required in Obj.column_headings():
+            field = Obj.heading_to_field(heading)
+            if required and field and (field != Obj.id_field) and (field not in create_kwargs):
+                raise ValueError("Required heading %s (or argument '%s') not found when creating %s" % (heading, field, Obj.base_name.capitalize()))
+        fields = {}
+        for field, data in create_kwargs.items():
+            model_field = Obj._meta.get_field(field)
+            if isinstance(data, models.Model):
+                fields[field] = data
+                continue
+            found = self.resolve(model_field.related_model, [data])
+            if str(data) not in found:
+                raise ValueError("Could not find %s '%s' when creating %s %s" % (model_field.related_model.base_name.capitalize(), str(data), Obj.base_name.capitalize(), name))
+            fields[model_field.attname] = found[str(data)]
+        return Obj(name=name, **fields)
+
+    def update_objects(self, records):
+        # (Obj, field) -> set of (pk, name of the Object to link)
+        links = defaultdict(set)
+        for kwargs in records:
+            obj_ids, create_kwargs, update_kwargs = Object._parse_kwargs(resolve_relations=False, **kwargs)
+            for Objs in update_kwargs:
+                Obj = Object.get_object_types(type_name=Objs)
+                obj_pks = self.resolve(Obj, obj_ids.get(Objs, [])).values()
+                for field, data in update_kwargs[Objs].items():
+                    names = data if type(data) == list else [data]
+                    for pk in obj_pks:
+                        for name in names:
+                            links[(Obj, field)].add((pk, str(name)))
+        for (Obj, field), pairs in links.items():
+            if field == "upstream":
+                Target = Obj
+            else:
+                Target = Obj._meta.get_field(field).related_model
+            found = self.resolve(Target, set([name for pk, name in pairs]))
+            pairs = set([(pk, found[name]) for pk, name in pairs if name in found])
+            if pairs:
+                self.link(Obj, field, pairs)
+
+    def link_matrix(self, Obj, field, names, target_names, index, target_index):
+        # Vectorized linking from the nonzero coordinates of a matrix whose
+        # axes are labelled by Object names, e.g. Sample.features from a count table
+        Target = Obj._meta.get_field(field).related_model
+        found = self.resolve(Obj, names)
+        target_found = self.resolve(Target, target_names)
+        pks = np.array([found.get(str(x), -1) for x in names], dtype=np.int64)
+        target_pks = np.array([target_found.get(str(x), -1) for x in target_names], dtype=np.int64)
+        pairs = np.column_stack((pks[index], target_pks[target_index]))
+        pairs = np.unique(pairs[(pairs >= 0).all(axis=1)], axis=0)
+        print("Linking %d %s to their %s" % (len(pairs), Obj.plural_name, field))
+        self.link(Obj, field, pairs.tolist())
+
+    def link(self, Obj, field, pairs):
+        model_field = Obj._meta.get_field(field)
+        if model_field.many_to_many:
+            if model_field.concrete:
+                through = model_field.remote_field.through
+                source = model_field.m2m_field_name()
+                target = model_field.m2m_reverse_field_name()
+            else:
+                # Reverse side of an M2M declared on the other model
+                through = model_field.through
+                source = model_field.field.m2m_reverse_field_name()
+                target = model_field.field.m2m_field_name()
+            pairs = list(pairs)
+            for start in range(0, len(pairs), self.batch_size):
+                rows = [through(**{source + "_id": pk, target + "_id": target_pk}) for pk, target_pk in pairs[start:start+self.batch_size]]
+                # The through tables are unique on the pair, so existing links are skipped
+                through.objects.bulk_create(rows, ignore_conflicts=True)
+            if field == "upstream":
+                # Keep the all_upstream cache in step with the new edges
+                Obj.update_closure(pairs)
+                if hasattr(Obj, "infer_step_upstream"):
+                    Obj.infer_step_upstream(results=Obj.objects.filter(pk__in=set([pk for pk, target_pk in pairs])))
+            return
+        targets = self._group_pairs(pairs)
+        if model_field.concrete:
+            # ForeignKey on this Object, one update per distinct target
+            # _parse_kwargs keeps one target per record, so more than one here
+            # means records disagree, and there's no telling which of them to keep
+            conflicts = [pk for pk, target_pks in targets.items() if len(target_pks) > 1]
+            if conflicts:
+                names = Obj.objects.filter(pk__in=conflicts[:10]).values_list("name", flat=True)
+                raise ValueError("Conflicting %s given for %s %s" % (field, Obj.plural_name, ", ".join(names)))
+            by_target = defaultdict(list)
+            for pk, target_pks in targets.items():
+                by_target[next(iter(target_pks))].append(pk)
+            for target_pk, pks in by_target.items():
+                Obj.objects.filter(pk__in=pks).update(**{model_field.attname: target_pk})
+        else:
+            # Reverse side of a ForeignKey declared on the other model
+            for pk, target_pks in targets.items():
+                model_field.related_model.objects.filter(pk__in=target_pks).update(**{model_field.field.attname: pk})
+
+    @staticmethod
+    def _group_pairs(pairs):
+        targets = defaultdict(set)
+        for pk, target_pk in pairs:
+            targets[pk].add(target_pk)
+        return targets
+
+    def ingest_values(self, records):
+        bulk, single = [], []
+        for kwargs in records:
+            try:
+                record = self._value_record(kwargs)
+            except Exception as e:
+                self._value_failed(kwargs, e)
+                continue
+            if record is None:
+                single.append(kwargs)
+            else:
+                bulk.append((kwargs, record))
+        if bulk:
+            errors = []
+            Value.bulk_create([record for kwargs, record in bulk], skip_existing=True, errors=errors,
+                              batch_size=self.batch_size, lock=self.concurrent)
+            failed = dict([(id(record), e) for record, e in errors])
+            for kwargs, record in bulk:
+                if id(record) in failed:
+                    self._value_failed(kwargs, failed[id(record)])
+        if single and self.concurrent:
+            # These go through their type's own get_or_create, which can't lock
+            # for us, so hold the signatures they may create for the rest of the batch
+            single_keys = []
+            for kwargs in single:
+                single_keys.append(DataSignature.lock_name(Value._clean_value_type(**kwargs), kwargs["value_name"]))
+            advisory_lock("signatures", single_keys)
+        for kwargs in single:
+            valClass = Value
+            if "value_type" in kwargs:
+                valClass = Value.get_value_types(type_name=kwargs["value_type"])
+            try:
+                # Savepoint, so one bad value doesn't poison the whole transaction
+                with transaction.atomic():
+                    value_kwargs = Value._parse_kwargs(**kwargs)
+                    vals = valClass.get_or_create(**value_kwargs)
+            except Exception as e:
+                self._value_failed(kwargs, e)
+
+    def _value_record(self, kwargs):
+        # Turns a scraped record into a Value.bulk_create record, with its
+        # Objects resolved through our name cache, or None if it has to go
+        # through its Value type's own get_or_create (see Value.bulk_safe), as
+        # do records that pin their signature with n_<objects>
+        valClass = Value._clean_value_type(**kwargs)
+        if any([x.startswith("n_") for x in kwargs]):
+            return None
+        record = {"name": kwargs["value_name"], "data": kwargs["value_data"], "value_type": valClass}
+        if "data_type" in kwargs:
+            record["data_type"] = kwargs["data_type"]
+        vobj_keys = [x for x in kwargs if x.startswith("value_object")]
+        stems = defaultdict(list)
+        for arg in kwargs:
+            stems[arg.split(".")[0]].append(kwargs[arg])
+        for vobj_key in vobj_keys:
+            Obj = Object.get_object_types(type_name=kwargs[vobj_key])
+            names = stems.get(Obj.base_name + "_" + Obj.id_field, [])
+            record[Obj.plural_name] = list(self.resolve(Obj, names).values())
+        if not valClass.bulk_safe([x for x in record if x in self.pks]):
+            return None
+        return record
+
+    @staticmethod
+    def _value_failed(kwargs, e):
+        print("Warning: failed to get/create value")
+        print(kwargs)
+        print(e)
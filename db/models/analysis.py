@@ -67,25 +67,25 @@ class Analysis(Object):
         # All samples for all Results coming out of this Analysis
         samples = apps.get_model("db", "Sample").objects.filter(pk__in=self.results.values("samples").distinct())
         if upstream:
-            samples = samples | apps.get_model("db", "Sample").objects.filter(pk__in=self.samples.values("all_upstream").distinct())
+            samples = samples | apps.get_model("db", "Sample").lineage(self.samples.all())
         return samples
 
     def related_steps(self, upstream=False):
         steps = self.extra_steps.all() | self.process.steps.all()
         if upstream:
-            steps = steps | apps.get_model("db", "Step").objects.filter(pk__in=steps.values("all_upstream").distinct())
+            steps = steps | apps.get_model("db", "Step").lineage(steps)
         return steps
 
     def related_processes(self, upstream=False):
         results = apps.get_model("db", "Process").objects.filter(pk=self.process.pk)
         if upstream:
-            processes = processes | apps.get_model("db", "Process").objects.filter(pk__in=processes.values("all_upstream").distinct())
+            processes = processes | apps.get_model("db", "Process").lineage(processes)
         return processes
 
     def related_results(self, upstream=False):
         results = self.results.all()
         if upstream:
-            results = results | apps.get_model("db", "Result").objects.filter(pk__in=results.values("all_upstream").distinct())
+            results = results | apps.get_model("db", "Result").lineage(results)
         return results
 
     def html_results_list(self):
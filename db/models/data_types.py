@@ -1,6 +1,14 @@
 import warnings
-
-from django.db import models
+import itertools
+import hashlib
+import functools
+from collections import defaultdict
+
+from django.db import models, connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.core.cache import cache
+from django.db.models.functions import MD5
 from django.apps import apps
 
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
@@ -21,7 +29,8 @@ from django_pandas.managers import DataFrameQuerySet
 #from .result import Result
 from .user import UserProfile
 from .object import Object
-from ..postgres import ArrayPosition, ArrayPositions, Unnest
+from ..postgres import ArrayPosition, ArrayPositions, Unnest, advisory_lock, bulk_create_polymorphic
+from ..registry import registry_for, all_subclasses
 
 import pandas as pd
 import ete3
@@ -32,12 +41,31 @@ import datetime
 import version_parser.version as version
 import re
 import io
+import skbio
 from scipy.sparse import coo_matrix
+from scipy.spatial.distance import squareform
 
 #This should be fine to live here, but may need to move if this file reloads often
 unitregistry = pint.UnitRegistry()
 pint.set_application_registry(unitregistry)
 Q_ = unitregistry.Quantity
+
+@functools.lru_cache(maxsize=None)
+def offset_unitregistry():
+    # A registry of its own for offset units (degC, degF), which converts them
+    # to kelvin in arithmetic, instead of toggling that on the shared registry
+    # in the middle of whatever other threads are doing with it
+    return pint.UnitRegistry(autoconvert_offset_to_baseunit=True)
+
+@functools.lru_cache(maxsize=65536)
+def parsed_magnitude(datum, x):
+    # Pint parsing is slow, and the same strings ("0:00:12.3", "25 degC") come
+    # up over and over, so the magnitude of x in datum.default_unit is kept
+    # for each PintDatum type. None means x doesn't parse as that type
+    try:
+        return datum.parse(x)
+    except Exception:
+        return None
 # CUSTOM FIELDS AND PARSERS
 # Probably move these to a fields.py soon
 
@@ -137,6 +165,60 @@ class DataSignature(models.Model):
     # -2: Any positive number of these objects may be attached
     object_counts = JSONField()
 
+    # Process-local copy of every signature (there are only a few hundred),
+    # indexed on (name, value_type pk), so most lookups cost no queries
+    # It's checked against a version counter in the shared cache, which is
+    # bumped whenever a signature is committed, edited, or deleted anywhere
+    signature_version_key = "quorem:signature_version"
+    _signatures = None
+    _signatures_version = None
+
+    @staticmethod
+    def signature_version():
+        return cache.get_or_set(DataSignature.signature_version_key, 0, timeout=None)
+
+    @staticmethod
+    def bump_signature_version():
+        try:
+            return cache.incr(DataSignature.signature_version_key)
+        except ValueError:
+            cache.set(DataSignature.signature_version_key, 1, timeout=None)
+            return 1
+
+    @staticmethod
+    def cached_signatures():
+        # {(name, value_type pk): [signatures]}, reloaded whenever the version has moved
+        version = DataSignature.signature_version()
+        if (DataSignature._signatures is None) or (version != DataSignature._signatures_version):
+            signatures = defaultdict(list)
+            for sig in DataSignature.objects.all():
+                signatures[(sig.name, sig.value_type_id)].append(sig)
+            DataSignature._signatures = signatures
+            DataSignature._signatures_version = version
+        return DataSignature._signatures
+
+    @staticmethod
+    def signatures_committed(signatures):
+        # Called once new signatures are committed, so we don't have to reload
+        # for our own creates unless someone else changed something in the meantime
+        # Uncommitted ones are never cached, since they'd outlive a rollback
+        version = DataSignature.bump_signature_version()
+        if (DataSignature._signatures is not None) and (version == DataSignature._signatures_version + 1):
+            for sig in signatures:
+                DataSignature._signatures[(sig.name, sig.value_type_id)].append(sig)
+            DataSignature._signatures_version = version
+
+    @staticmethod
+    def lock_name(value_type, name):
+        # What anything about to create a signature advisory-locks on, under "signatures"
+        return "%s:%s" % (value_type.base_name, name)
+
+    @staticmethod
+    def cached_matches(name, ctype, object_counts):
+        # Same matching as the object_counts__contains lookup in get()
+        return [sig for sig in DataSignature.cached_signatures().get((name, ctype.pk), [])
+                if all([sig.object_counts.get(k) == v for k, v in object_counts.items()])]
+
     def __str__(self):
         link_str = ", ".join(["%d %s" % (self.object_counts[Obj.plural_name],Obj.plural_name) for Obj in Object.get_object_types()])
         return "%s '%s' storing %s, linked to %s" % (str(self.value_type).capitalize(), self.name, ", ".join([x.model_class().__name__ for x in self.data_types.all() if x.model_class()]), link_str)
@@ -174,6 +256,7 @@ class DataSignature(models.Model):
         if not signatures.exists():
             signature = cls.create(name, ctype, object_counts)
             signatures = DataSignature.objects.filter(pk=signature.pk)
+            signatures._result_cache = [signature]
         return signatures
 
     @classmethod
@@ -198,44 +281,73 @@ class DataSignature(models.Model):
                                                                      model_name="Value").get_value_types(type_name=value_type))
         else:
             ctype = ContentType.objects.get_for_model(value_type)
-        signatures = DataSignature.objects.filter(name=name,
-                     object_counts__contains=object_counts,
-                     value_type=ctype)
+        found = DataSignature.cached_matches(name, ctype, object_counts)
+        if found:
+            signatures = DataSignature.objects.filter(pk__in=[sig.pk for sig in found])
+            # Hand back the cached rows, so len()/[0]/exists() don't query again
+            signatures._result_cache = found
+        else:
+            # May be one we made earlier in this transaction
+            signatures = DataSignature.objects.filter(name=name,
+                         object_counts__contains=object_counts,
+                         value_type=ctype)
         if return_counts:
             return (signatures, object_counts)
         return signatures
 
+@receiver(post_save, sender=DataSignature)
+def signature_saved(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: DataSignature.signatures_committed([instance]))
+    else:
+        transaction.on_commit(DataSignature.bump_signature_version)
+
+@receiver(post_delete, sender=DataSignature)
+def signature_deleted(sender, instance, **kwargs):
+    transaction.on_commit(DataSignature.bump_signature_version)
+
 #Generic superclass that allows us to automatically list
 #Any new types defined here without needing to know their
 #names out there
 class Data(PolymorphicModel):
     type_name = "data"
     atomic = False
+    # Types with a value_hash column are matched on it instead of on the value itself
+    hashed = False
+    # Set once a hashed type has no rows left without a hash (see _match_unhashed)
+    _all_hashed = False
     native_type = None
     cast_function = lambda x: x
     db_cast_function = lambda x: x
 
     values = models.ManyToManyField("Value", related_name="data")
 
+
+    @staticmethod
+    def type_registry():
+        return registry_for(Data, lambda: all_subclasses(Data), lambda datum: [datum.type_name, datum.__name__])
+
     @classmethod
-    def get_data_types(cls, data=None, type_name=None, **kwargs):
+    def get_data_types(cls, data=None, type_name=None, ctype=None, **kwargs):
         #Convenience function for get_data_types that returns one by name, or
         #returns the inferred value, if not named
         # Take in a string data_type and return the Datum model
+        if ctype is not None:
+            datum = Data.type_registry().from_ctype(ctype)
+            if datum is None:
+                raise ValueError("Unrecognized requested data type ContentType %s" % (ctype,))
+            return datum
         if type_name is not None:
-            for datum in Data.get_data_types():
-                if (datum.type_name == type_name.lower()) or (datum.__name__.lower() == type_name.lower()):
-                    return datum
-            raise ValueError("Unrecognized requested 'data_type'/'type_name' of %s" % (type_name,))
+            datum = Data.type_registry().get(type_name)
+            if datum is None:
+                raise ValueError("Unrecognized requested 'data_type'/'type_name' of %s" % (type_name,))
+            return datum
         if data is not None:
             return cls.infer_type(data, **kwargs)
-        data_subclasses = set()
-        def all_subclasses(c, data_subclasses):
-            for sc in c.__subclasses__():
-                data_subclasses.add(sc)
-                data_subclasses = all_subclasses(sc, data_subclasses)
-            return data_subclasses
-        return all_subclasses(Data, data_subclasses)
+        # Every type below this one, e.g., PintDatum.get_data_types() is just the Pint types
+        if cls is Data:
+            return list(Data.type_registry())
+        return Data.type_registry().subclasses_of(cls)
 
     def __str__(self):
         return str(self.get_value())
@@ -261,7 +373,83 @@ class Data(PolymorphicModel):
         return self.value
 
     @classmethod
-    def infer_type(cls, value, **kwargs):
+    def value_lookup(cls):
+        # The lookup from Data to the column that holds this type's value, e.g.,
+        # "pintdatum__value" for every PintDatum type, or None if get_value()
+        # needs a model instance (relations, files, matrices)
+        if cls.get_value is not Data.get_value:
+            return None
+        try:
+            field = cls._meta.get_field("value")
+        except exceptions.FieldDoesNotExist:
+            return None
+        if field.is_relation or isinstance(field, models.FileField):
+            return None
+        # The column may sit on a parent table, e.g., LinkDatum for LocalLinkDatum
+        chain = [mdl for mdl in reversed(field.model._meta.get_parent_list()) if mdl is not Data]
+        return "__".join([mdl._meta.model_name for mdl in chain + [field.model]] + ["value"])
+
+    @staticmethod
+    def value_frame(vals, fieldnames, index_col):
+        # Reads fieldnames off a Value QuerySet into a DataFrame indexed on index_col,
+        # with the value of each Value's Data in place of the "data" column
+        # Each value column is joined onto the Values in SQL, one query per
+        # column, so all of the Pint types come back in one query as floats, and
+        # only the types that need get_value() are loaded as model instances
+        fieldnames = list(fieldnames)
+        data_col = fieldnames.index("data")
+        lookups = defaultdict(list)
+        for ctype_id in vals.values_list("data__polymorphic_ctype", flat=True).distinct():
+            if ctype_id is not None:
+                lookups[Data.get_data_types(ctype=ctype_id).value_lookup()].append(ctype_id)
+        frames = []
+        for lookup, ctype_ids in lookups.items():
+            type_vals = vals.filter(data__polymorphic_ctype__in=ctype_ids)
+            columns = list(fieldnames)
+            if lookup is not None:
+                # values_list reuses the join from the filter, so this is this Value's own Data
+                columns[data_col] = "data__" + lookup
+            frame = pd.DataFrame.from_records(list(type_vals.values_list(*columns)), columns=fieldnames)
+            if lookup is None:
+                data = Data.objects.filter(pk__in=frame["data"].unique().tolist()).get_real_instances()
+                values = {x.pk: x.get_value() for x in data}
+                frame["data"] = frame["data"].apply(lambda x: values[x])
+            frames.append(frame)
+        if frames:
+            df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        else:
+            df = pd.DataFrame(columns=fieldnames)
+        return df.set_index(index_col)
+
+    @staticmethod
+    def iter_value_frames(vals, fieldnames, index_col, chunk_size=10000):
+        # Streaming value_frame: one server-side cursor over the Values in
+        # (Value, Data) order, yielding DataFrames of at most chunk_size rows
+        # Each chunk fetches its values with one query per value column
+        fieldnames = list(fieldnames)
+        rows = vals.order_by("pk", "data").values_list(*(fieldnames + ["data__polymorphic_ctype"])).iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            frame = pd.DataFrame.from_records(chunk, columns=fieldnames + ["data_ctype"])
+            pks = defaultdict(list)
+            for ctype_id, data_pks in frame.dropna(subset=["data_ctype"]).groupby("data_ctype")["data"]:
+                datum = Data.get_data_types(ctype=int(ctype_id))
+                # Types that share a value column, e.g., every PintDatum, share a query
+                owner = datum._meta.get_field("value").model if datum.value_lookup() is not None else None
+                pks[owner].extend(data_pks.unique().tolist())
+            values = {}
+            for owner, data_pks in pks.items():
+                if owner is not None:
+                    values.update(owner.objects.filter(pk__in=data_pks).values_list("pk", "value"))
+                else:
+                    values.update({x.pk: x.get_value() for x in Data.objects.filter(pk__in=data_pks).get_real_instances()})
+            frame["data"] = frame["data"].map(values.get)
+            yield frame.drop(columns="data_ctype").set_index(index_col)
+
+    @classmethod
+    def infer_type(cls, value, signature=None, **kwargs):
         #First, check if the user piped us a hint/request
         if "data_type" in kwargs:
             requested_type = kwargs["data_type"]
@@ -270,19 +458,56 @@ class Data(PolymorphicModel):
                     return vtype
             #Couldn't find the hint, warn and infer
             warnings.warn("Could not find requested data type %s, attempting to infer" % (kwargs["data_type"],))
+        if type(value) == str:
+            # Values under one signature are usually all the same type, so once one
+            # has been inferred, later ones only have to pass that type's cast
+            # StrDatum is only ever the fallback, so it isn't remembered
+            known = Data.signature_types.get(signature) if signature is not None else None
+            if known is not None:
+                try:
+                    known.cast_function(value)
+                    return known
+                except:
+                    pass
+            vtype = Data._infer_str_type(value)
+            if (signature is not None) and (vtype is not StrDatum):
+                Data.signature_types[signature] = vtype
+            return vtype
         #Second, check if the data is of an advanced type that we understand
         for vtype in cls.get_data_types():
-            if (type(value) != str) and (type(value) == vtype.native_type):
+            if type(value) == vtype.native_type:
                 # Catch and handle it more specifically if it's a Pint unit
                 if type(value) == Q_:
                     for qtype in PintDatum.get_data_types():
                         if qtype.eq_dimensionality(value):
                             return qtype
                 return vtype
+        return Data._cast_order_type(value)
+
+    # Winning type per DataSignature pk, for infer_type(signature=...)
+    signature_types = {}
+    int_pattern = re.compile(r"^[+-]?\d+$")
+    float_pattern = re.compile(r"^[+-]?(\d+\.\d*|\.\d+|\d+)([eE][+-]?\d+)?$")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def _infer_str_type(value):
+        # Memoized, since the same strings come up over and over (package
+        # versions, runtimes, units), and the slow path parses each one with
+        # every cast, Pint's included
+        # Plain integers and decimals can't be anything earlier in the cast order
+        if Data.int_pattern.match(value):
+            return IntDatum
+        if Data.float_pattern.match(value):
+            return FloatDatum
+        return Data._cast_order_type(value)
+
+    @staticmethod
+    def _cast_order_type(value):
         # Finally, we go through the types in a sensible order, trying casts
         # until one works
         cast_order = [ IntDatum, FloatDatum, DatetimeDatum, CoordDatum ] + \
-                     [ VersionDatum ] + PintDatum.__subclasses__()
+                     [ VersionDatum ] + PintDatum.get_data_types()
         castable = []
         for mdl in cast_order:
             try:
@@ -305,10 +530,24 @@ class Data(PolymorphicModel):
             value = cls.cast(value)
         except:
             raise ValueError("Cannot parse value %s with cast function for data type %s" % (str(value), cls.type_name))
+        return cls._get_or_create_cast(value)
+
+    @classmethod
+    def _get_or_create_cast(cls, value):
+        # get_or_create() for a value that has already been through cls.cast()
         if type(value) != dict:
-            qs = cls.objects.filter(value=value)
-            if qs.exists():
-                return qs.get()
+            if cls.hashed:
+                qs = cls.objects.filter(value_hash=cls.hash_value(value))
+            else:
+                qs = cls.objects.filter(value=value)
+            # Oldest first, in case a race ever did leave a duplicate behind
+            obj = qs.order_by("pk").first()
+            if obj is not None:
+                return obj
+            if cls.hashed:
+                unhashed = cls._match_unhashed([value])
+                if value in unhashed:
+                    return cls.objects.get(pk=unhashed[value])
             obj = cls.objects.create(value=value)
         else:
             #Special case: only MatrixDatum at the moment
@@ -318,12 +557,177 @@ class Data(PolymorphicModel):
             obj = cls.objects.create(**value)
         return obj
 
+    @classmethod
+    def get_or_create_many(cls, values, batch_size=5000, casted=None, lock=False):
+        # get_or_create() for many values at once, returning their pks in order
+        # casted can hand in cls.cast() of each value, if the caller already has it
+        # With lock, values of types without a unique hash are advisory-locked
+        # before they're created, for when other transactions may create them too
+        # Hashed types are matched with one value_hash lookup per batch, and the
+        # missing ones inserted with INSERT ... ON CONFLICT on the unique hash
+        # Other plain columns are matched on value__in and bulk inserted, and the
+        # rest (relations, matrices, arrays) go through get_or_create() one by one
+        values = list(values)
+        if casted is None:
+            casted = []
+            for value in values:
+                try:
+                    casted.append(cls.cast(value))
+                except:
+                    raise ValueError("Cannot parse value %s with cast function for data type %s" % (str(value), cls.type_name))
+        if cls.hashed:
+            field = "value_hash"
+            keys = [cls.hash_value(x) for x in casted]
+        elif (cls.value_lookup() is not None) and (not hasattr(cls._meta.get_field("value"), "from_db_value")) and \
+             all([isinstance(x, (str, int, float, datetime.datetime)) for x in casted]):
+            # These come back from the database as they went in, so they can be matched on
+            field = "value"
+            keys = casted
+        else:
+            return [cls._get_or_create_cast(value).pk for value in casted]
+        pks = {}
+        unique = list(dict.fromkeys(keys))
+        for start in range(0, len(unique), batch_size):
+            for key, pk in cls.objects.filter(**{field + "__in": unique[start:start+batch_size]}).values_list(field, "pk"):
+                pks.setdefault(key, pk)
+        missing = {}
+        for key, value in zip(keys, casted):
+            if key not in pks:
+                missing.setdefault(key, value)
+        if missing and cls.hashed:
+            unhashed = cls._match_unhashed(list(missing.values()), batch_size=batch_size)
+            for key, value in list(missing.items()):
+                if value in unhashed:
+                    pks[key] = unhashed[value]
+                    del missing[key]
+        if missing and cls.hashed:
+            missing = list(missing.items())
+            for start in range(0, len(missing), batch_size):
+                pks.update(cls._insert_hashed(missing[start:start+batch_size]))
+        elif missing:
+            if lock:
+                # Someone holding the lock may have committed some of these while we waited
+                advisory_lock("data:" + cls.type_name, missing.keys())
+                for key, pk in cls.objects.filter(value__in=list(missing.keys())).values_list("value", "pk"):
+                    pks.setdefault(key, pk)
+                    missing.pop(key, None)
+            for datum in bulk_create_polymorphic(cls, [cls(value=x) for x in missing.values()], batch_size=batch_size):
+                pks[datum.value] = datum.pk
+        return [pks[key] for key in keys]
+
+    @classmethod
+    def _insert_hashed(cls, missing):
+        # missing is [(hash, value)], returns {hash: pk} for all of them
+        # Data ids are drawn up front so both tables can be written in one
+        # statement, and rows some other ingest got in first are skipped by the
+        # unique index, then their parent rows cleaned up and looked up again
+        qn = connection.ops.quote_name
+        root = Data._meta.db_table
+        ptr = qn(cls._meta.pk.column)
+        value_field = cls._meta.get_field("value")
+        ctype_id = ContentType.objects.get_for_model(cls, for_concrete_model=False).pk
+        sql = """WITH new_rows AS (
+                     SELECT nextval(pg_get_serial_sequence(%s, 'id')) AS id, v.value_hash, v.value
+                     FROM unnest(%s::varchar[], %s::{value_type}[]) AS v(value_hash, value)),
+                 parents AS (
+                     INSERT INTO {root} (id, polymorphic_ctype_id) SELECT id, %s FROM new_rows),
+                 children AS (
+                     INSERT INTO {child} ({ptr}, {value}, {value_hash}) SELECT id, value, value_hash FROM new_rows
+                     ON CONFLICT ({value_hash}) DO NOTHING
+                     RETURNING {ptr})
+                 SELECT new_rows.id, new_rows.value_hash, children.{ptr} IS NOT NULL
+                 FROM new_rows LEFT JOIN children ON children.{ptr} = new_rows.id""".format(
+                     value_type=value_field.db_type(connection), root=qn(root), child=qn(cls._meta.db_table), ptr=ptr,
+                     value=qn(value_field.column), value_hash=qn(cls._meta.get_field("value_hash").column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [root, [key for key, value in missing], [value for key, value in missing], ctype_id])
+            rows = cursor.fetchall()
+        pks = {key: pk for pk, key, inserted in rows if inserted}
+        lost = [(pk, key) for pk, key, inserted in rows if not inserted]
+        if lost:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM {root} WHERE id = ANY(%s)".format(root=qn(root)), [[pk for pk, key in lost]])
+            pks.update(cls.objects.filter(value_hash__in=[key for pk, key in lost]).values_list("value_hash", "pk"))
+        return pks
+
+    @classmethod
+    def _match_unhashed(cls, values, batch_size=5000):
+        # {value: pk} for rows of a hashed type that were stored before it had a
+        # value_hash, which are matched on the value itself until fill_value_hashes()
+        # (manage.py hashdata) has run. Looking for them is an index lookup on the
+        # NULL hashes, and once there are none left we stop looking, since every
+        # row saved since gets its hash
+        if cls._all_hashed:
+            return {}
+        qs = cls.objects.filter(value_hash__isnull=True)
+        if not qs.exists():
+            cls._all_hashed = True
+            return {}
+        values = list(set(values))
+        found = {}
+        for start in range(0, len(values), batch_size):
+            for value, pk in qs.filter(value__in=values[start:start+batch_size]).order_by("-pk").values_list("value", "pk"):
+                found[value] = pk
+        return found
+
+    @classmethod
+    def hash_value(cls, value):
+        return hashlib.md5(str(value).encode("utf-8")).hexdigest()
+
+    def save(self, *args, **kwargs):
+        if self.hashed and not self.value_hash:
+            self.value_hash = self.hash_value(self.value)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def fill_value_hashes():
+        # Hashes any rows of the hashed types stored before they had one, in the
+        # database, where md5() of the UTF-8 text matches hash_value()
+        # Nothing kept those rows unique, so copies of a value are first merged
+        # into the oldest one (taking their Values along), or the unique index
+        # on value_hash would refuse the update
+        qn = connection.ops.quote_name
+        through = Data._meta.get_field("values").remote_field.through
+        for datum in Data.get_data_types():
+            if (not datum.hashed) or (not datum.objects.filter(value_hash__isnull=True).exists()):
+                continue
+            names = {"root": qn(Data._meta.db_table), "child": qn(datum._meta.db_table),
+                     "ptr": qn(datum._meta.pk.column), "value": qn(datum._meta.get_field("value").column),
+                     "through": qn(through._meta.db_table),
+                     "data": qn(through._meta.get_field("data").column),
+                     "value_id": qn(through._meta.get_field("value").column)}
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("""WITH dups AS (
+                                          SELECT id, keep FROM (
+                                              SELECT {ptr} AS id, first_value({ptr}) OVER (PARTITION BY md5({value}) ORDER BY {ptr}) AS keep
+                                              FROM {child}) d
+                                          WHERE id != keep),
+                                      moved AS (
+                                          INSERT INTO {through} ({data}, {value_id})
+                                          SELECT dups.keep, t.{value_id} FROM {through} t JOIN dups ON t.{data} = dups.id
+                                          ON CONFLICT DO NOTHING),
+                                      unlinked AS (
+                                          DELETE FROM {through} WHERE {data} IN (SELECT id FROM dups)),
+                                      children AS (
+                                          DELETE FROM {child} WHERE {ptr} IN (SELECT id FROM dups))
+                                      DELETE FROM {root} WHERE id IN (SELECT id FROM dups)""".format(**names))
+                    if cursor.rowcount > 0:
+                        print("Merged %d duplicate %s" % (cursor.rowcount, datum.__name__))
+                datum.objects.filter(value_hash__isnull=True).update(value_hash=MD5("value"))
+
 class StrDatum(Data):
     atomic = True
+    hashed = True
     type_name = "str"
     native_type = str
     cast_function = str
+    # Matched through the hash, since a btree on the text itself bloats on long
+    # strings (e.g., taxonomies) and can't hold values past its row size limit
+    # The old index stays until every deployment has run manage.py hashdata,
+    # since rows from before value_hash are matched on the text until then
     value = models.TextField(db_index=True)
+    value_hash = models.CharField(max_length=32, unique=True, null=True, editable=False)
 
 class IntDatum(Data):
     atomic = True
@@ -403,9 +807,19 @@ class PintDatum(Data):
 
     @classmethod
     def cast_function(cls, x):
+        if type(x) != str:
+            return Q_(cls.parse(x), cls.default_unit)
+        magnitude = parsed_magnitude(cls, x)
+        if magnitude is None:
+            raise ValueError("Cannot parse %s as a %s" % (x, cls.type_name))
+        return Q_(magnitude, cls.default_unit)
+
+    @classmethod
+    def parse(cls, x):
+        # The magnitude of x in default_unit, see cast_function for the cached version
         val = unitregistry(x).to(cls.default_unit)
         if type(val) == cls.native_type:
-            return val
+            return val.magnitude
         else:
             raise ValueError
 
@@ -430,11 +844,8 @@ class TemperatureDatum(PintDatum):
     default_unit = unitregistry.Unit("celsius")
 
     @classmethod
-    def cast_function(cls, x):
-        unitregistry.autoconvert_offset_to_baseunit = True
-        quantity = unitregistry(x).to(cls.default_unit)
-        unitregistry.autoconvert_offset_to_baseunit = False
-        return quantity
+    def parse(cls, x):
+        return offset_unitregistry()(x).to(str(cls.default_unit)).magnitude
 
 # This is NOT a Datetime, but rather an *amount* of time
 class TimeDatum(PintDatum):
@@ -442,13 +853,13 @@ class TimeDatum(PintDatum):
     default_unit = unitregistry.Unit("second")
 
     @classmethod
-    def cast_function(cls, x):
+    def parse(cls, x):
         if "and" in x:
             val = sum([unitregistry(t.replace("and","")).to(cls.default_unit) for t in x.split(",") if "microseconds" not in t])
         else:
             val = unitregistry(x).to(cls.default_unit)
         if type(val) == cls.native_type:
-            return val
+            return val.magnitude
         else:
             raise ValueError
 
@@ -553,12 +964,17 @@ class COOMatrixDatum(Data):
     colobj = models.ForeignKey(ContentType, related_name="matrix_col", on_delete=models.CASCADE)
 
     def db_cast_function(value):
-        assert type(value) == pd.DataFrame
-        coo_mat = value.sparse.to_coo()
+        if type(value) == pd.DataFrame:
+            coo_mat = value.sparse.to_coo()
+            row_names = value.index.tolist()
+            col_names = value.columns.tolist()
+        else:
+            # A scipy sparse matrix carrying its own labels, e.g. from the FeatureTable scraper
+            coo_mat = value.tocoo()
+            row_names = list(value.row_names)
+            col_names = list(value.col_names)
         row = coo_mat.row.tolist()
-        row_names = value.index.tolist()
         col = coo_mat.col.tolist()
-        col_names = value.columns.tolist()
         data = coo_mat.data.tolist()
         return {'value': data, 
                 'row': row, 
@@ -587,6 +1003,38 @@ class COOMatrixDatum(Data):
             # Add the features to the Sample
             Sample.objects.get(pk=sample_pk).features.add(*Feature.objects.filter(pk__in=feats))
 
+class DistanceMatrixDatum(Data):
+    # A symmetric, hollow matrix (e.g., beta diversity) stored in condensed form,
+    # i.e., the upper triangle row by row, as in scipy's squareform
+    type_name = "distancematrix"
+    native_type = skbio.DistanceMatrix
+    value = ArrayField(base_field=models.FloatField())
+    names = ArrayField(base_field=models.CharField(max_length=255))
+    # The Object type that the rows/columns are named after
+    obj = models.ForeignKey(ContentType, related_name="distance_matrix", on_delete=models.CASCADE)
+
+    def db_cast_function(value):
+        obj = getattr(value, "obj", "sample")
+        if type(value) == pd.DataFrame:
+            value = skbio.DistanceMatrix(value.values, ids=[str(x) for x in value.index])
+        return {'value': value.condensed_form().tolist(),
+                'names': list(value.ids),
+                'obj': ContentType.objects.get_by_natural_key('db', obj)}
+    def __str__(self):
+        return "Distance Matrix between %d %s" % (len(self.names), self.obj.model_class().plural_name)
+    def get_value(self):
+        return skbio.DistanceMatrix(squareform(self.value, force="tomatrix", checks=False), ids=self.names)
+    def distance(self, name_a, name_b):
+        # Looks a pair up in the condensed array without expanding the matrix
+        i = self.names.index(name_a)
+        j = self.names.index(name_b)
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        n = len(self.names)
+        return self.value[n*i - (i*(i+1))//2 + (j-i-1)]
+
 #class BitStringDatum(Data):
 #    type_name = "bitstring"
 #    cast_function = None
@@ -595,9 +1043,11 @@ class COOMatrixDatum(Data):
 class SequenceDatum(Data):
     # A container for a biological sequence
     type_name = "sequence"
+    hashed = True
     # Can be either a FASTA entry, a FASTQ entry, or just a plain sequence
     # All stored as text and inferred/converted later for whatever purpose
     value = models.TextField()
+    value_hash = models.CharField(max_length=32, unique=True, null=True, editable=False)
 
 class NewickTreeDatum(Data):
     type_name = "newicktree"
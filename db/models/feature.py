@@ -65,14 +65,14 @@ class Feature(Object):
         #SQL Depth: 1
         samples = self.samples.all()
         if upstream:
-            samples = samples | apps.get_model("db", "Sample").objects.filter(pk__in=self.samples.values("all_upstream").distinct())
+            samples = samples | apps.get_model("db", "Sample").lineage(self.samples.all())
         return samples
 
     def related_results(self, upstream=False):
         # SQL Depth: 2
         results = self.results.all()
         if upstream:
-            results = results | apps.get_model("db", "Result").objects.filter(pk__in=results.values("all_upstream").distinct())
+            results = results | apps.get_model("db", "Result").lineage(results)
         return results
 
     def html_samples(self):
@@ -105,7 +105,7 @@ class Feature(Object):
                     htm += "<tr><td border=\"1\" bgcolor=\"#ffffff\">%s</td>" % (vtype,)
                     htm += "<td border=\"1\" bgcolor=\"#ffffff\">%d</td></tr>" % (count,)
             for data_type_pk in data_types:
-                data_type = ContentType.objects.get_for_id(data_type_pk).model_class()
+                data_type = apps.get_model("db.Data").get_data_types(ctype=data_type_pk)
             htm += "<tr><td colspan=\"2\"></td></tr>"
         htm += "</table>>"
         
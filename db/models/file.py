@@ -31,6 +31,13 @@ class UploadFile(models.Model):
     logfile = models.OneToOneField("LogFile", on_delete=models.CASCADE, related_name="file")
     upload_status = models.CharField(max_length=1, choices=STATUS_CHOICES)
     upload_type = models.CharField(max_length=1, choices=TYPE_CHOICES)
+    # Checkpoint of the ingestion: the last phase reached, and how many of its batches are committed
+    # A retried ingest resumes from here instead of starting over
+    ingest_phase = models.CharField(max_length=32, blank=True, default="")
+    ingest_batch = models.IntegerField(default=0)
+    # Anything the ingest decided to skip up front (e.g., provenance already in the
+    # database), saved with the first checkpoint so a resumed ingest skips the same
+    ingest_skip = models.JSONField(null=True, blank=True)
     #Should upload files be indexed by the search??
     #search_vector = SearchVectorField(null=True)
 
@@ -54,6 +61,13 @@ class UploadFile(models.Model):
 
     def update(self, *args, **kwargs):
         super().save(*args, **kwargs)
+
+    def checkpoint(self, phase, batch):
+        # Written inside the same transaction as the batch it records
+        self.ingest_phase = phase
+        self.ingest_batch = batch
+        UploadFile.objects.filter(pk=self.pk).update(ingest_phase=phase, ingest_batch=batch,
+                                                     ingest_skip=self.ingest_skip)
         
 class LogFile(models.Model):
     base_name = "log"
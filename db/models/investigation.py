@@ -25,7 +25,7 @@ class Investigation(Object):
         # SQL Depth: 1
         samples = self.samples.all()
         if upstream:
-            samples = samples | apps.get_model("db", "Sample").objects.filter(pk__in=self.samples.values("all_upstream").distinct())
+            samples = samples | apps.get_model("db", "Sample").lineage(self.samples.all())
 
     def html_samples(self):
         sample_count = self.samples.count()
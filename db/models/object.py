@@ -1,14 +1,17 @@
 from collections import defaultdict, OrderedDict
 from textwrap import fill, wrap
 import string
+import time
 
 from django import forms
 from django.forms import ModelForm 
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 from django.views.generic.edit import UpdateView, CreateView
-from django.db import models
+from django.db import models, connection, transaction
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.cache import cache
 from django.urls import reverse
 from django.forms.utils import flatatt
 from django.utils.html import format_html, mark_safe
@@ -20,7 +23,10 @@ from django.contrib.postgres.indexes import GinIndex
 from django.shortcuts import render
 from combomethod import combomethod
 
+from ..registry import registry_for
+
 import pandas as pd
+import numpy as np
 import graphviz as gv
 import colour
 
@@ -35,9 +41,61 @@ User = get_user_model()
 # Generic Base Class for Objects #
 #
 
+class KwargsPlan:
+    # Lookup plan for Object._parse_kwargs, mapping each input column heading
+    # (e.g., "sample_name", "result_upstream") to the Object type and field it
+    # feeds. Input keys match a heading if they start with it, e.g., "sample_name.3"
+    def __init__(self, object_types):
+        # Parallel lists of headings and their (Object, field, m2m, required, relational)
+        self.headings = []
+        self.entries = []
+        for Obj in object_types:
+            for heading, required in Obj.column_headings():
+                base_type = Object.get_object_types(type_name=heading.split("_")[0])
+                field, m2m = base_type.heading_to_field(heading, m2m=True)
+                if field:
+                    self.headings.append(heading)
+                    self.entries.append((base_type, field, m2m, required, base_type.relational_field(field)))
+        # Key stem (the part before any ".") -> indices of the headings it matches
+        self.matches = {}
+
+    def match(self, key):
+        stem = key.split(".")[0]
+        if stem not in self.matches:
+            # A heading has no ".", so it's a prefix of the key exactly when it's a prefix of the stem
+            self.matches[stem] = [idx for idx, heading in enumerate(self.headings) if stem.startswith(heading)]
+        return self.matches[stem]
+
+class ProvenanceBump:
+    # The on_commit callback behind Object.bump_provenance_version, collecting
+    # everything one transaction touched so its lineage is looked up only once
+    def __init__(self):
+        self.pks = defaultdict(set)
+
+    def __call__(self):
+        try:
+            keys = []
+            for Obj, pks in self.pks.items():
+                if not pks:
+                    continue
+                pks = set(pks)
+                if Obj.has_upstream:
+                    objs = Obj.objects.filter(pk__in=list(pks))
+                    pks.update(Obj.lineage(objs).values_list("pk", flat=True))
+                    pks.update(Obj.lineage(objs, downstream=True).values_list("pk", flat=True))
+                keys.extend([Object.provenance_version_key(Obj, pk) for pk in pks])
+            # The next read starts a fresh version from the clock
+            cache.delete_many(keys)
+        except Exception as e:
+            # The data is committed either way, at worst graphs are stale until they expire
+            print("Warning: could not bump provenance versions")
+            print(e)
+
 class Object(models.Model):
     base_name = "object"
     plural_name = "objects"
+    # Built on first use by kwargs_plan()
+    _kwargs_plan = None
     id_field = "name"
     has_upstream = False
     search_set = None
@@ -91,7 +149,7 @@ class Object(models.Model):
         val_fields = defaultdict(set)
         objs = apps.get_model("db.DataSignature").objects.filter(object_counts__results__gt=0).values_list("value_type","name").distinct()
         for vpk, name in objs:
-            val_fields[ContentType.objects.get_for_id(vpk).model_class().base_name].add(name)
+            val_fields[apps.get_model("db.Value").get_value_types(ctype=vpk).base_name].add(name)
         return val_fields
 
     def get_value_fields(self):
@@ -168,50 +226,60 @@ class Object(models.Model):
         return (None, None) if m2m else None
 
     @classmethod
-    def _parse_kwargs(cls, value_kwargs=False, **kwargs):
-        # Parses input arguments from the user-friendly IO fields into API-friendly keyword fields
-        object_types = Object.get_object_types()
-        object_ids = {Obj.plural_name: [] for Obj in object_types}
-        create_kwargs = {Obj.plural_name: {} for Obj in object_types}
-        update_kwargs = {Obj.plural_name: {} for Obj in object_types}
+    def save_order(cls):
         # Rough save order for getting existence straightened out #TODO: Introspect this through related fields
-        object_order = [apps.get_model("db.Investigation"),
-                        apps.get_model("db.Step"),
-                        apps.get_model("db.Sample"),
-                        apps.get_model("db.Feature"),
-                        apps.get_model("db.Process"),
-                        apps.get_model("db.Analysis"),
-                        apps.get_model("db.Result")]
-        object_headings = [y for x in [x.column_headings() for x in object_order] for y in x]
-        for column_heading, required in object_headings:
-            keys = [x for x in kwargs if x.startswith(column_heading)]
-            vals = [kwargs[x] for x in kwargs if x.startswith(column_heading)]
-            base_type = Object.get_object_types(type_name=column_heading.split("_")[0])
-            field, m2m = base_type.heading_to_field(column_heading, m2m=True)
-            if field:
-                if field in kwargs:
-                    keys.append(field)
-                if len(keys) == 0:
-                    continue
-                if field == base_type.id_field:
-                    for k in keys:
-                        object_ids[base_type.plural_name] = vals
+        return [apps.get_model("db.Investigation"),
+                apps.get_model("db.Step"),
+                apps.get_model("db.Sample"),
+                apps.get_model("db.Feature"),
+                apps.get_model("db.Process"),
+                apps.get_model("db.Analysis"),
+                apps.get_model("db.Result")]
+
+    @classmethod
+    def _parse_kwargs(cls, value_kwargs=False, resolve_relations=True, **kwargs):
+        # Parses input arguments from the user-friendly IO fields into API-friendly keyword fields
+        # If resolve_relations is False, relational fields are left as the names given in
+        # kwargs (a list for m2m fields) so the caller can resolve them in bulk
+        plan = Object.kwargs_plan()
+        object_ids = {}
+        create_kwargs = {}
+        update_kwargs = {}
+        # One pass over the kwargs, collecting the values for each heading they start with
+        heading_vals = defaultdict(list)
+        for key, val in kwargs.items():
+            for idx in plan.match(key):
+                heading_vals[idx].append(val)
+        for idx in sorted(heading_vals):
+            base_type, field, m2m, required, relational = plan.entries[idx]
+            vals = heading_vals[idx]
+            if field == base_type.id_field:
+                object_ids[base_type.plural_name] = vals
+                continue
+            if relational:
+                if not resolve_relations:
+                    data = vals if m2m else vals[0]
                 else:
-                    if base_type.relational_field(field):
-                        data = base_type._meta.get_field(field).related_model.objects.filter(name__in=vals)
-                        if not data.exists():
-                            continue #Skip it. TODO: indicate it's not found somehow, so we don't have to iterate twice (once for create, once for update) and can just add it later
-                        if not m2m:
-                            data = data.first()
-                    if required and (field != "upstream"):
-                        create_kwargs[base_type.plural_name][field] = data
-                    if not required or (field == base_type.id_field) or (field=="upstream"):
-                        update_kwargs[base_type.plural_name][field] = data
+                    data = base_type._meta.get_field(field).related_model.objects.filter(name__in=vals)
+                    if not data.exists():
+                        continue #Skip it. TODO: indicate it's not found somehow, so we don't have to iterate twice (once for create, once for update) and can just add it later
+                    if not m2m:
+                        data = data.first()
+            if required and (field != "upstream"):
+                create_kwargs.setdefault(base_type.plural_name, {})[field] = data
+            if not required or (field=="upstream"):
+                update_kwargs.setdefault(base_type.plural_name, {})[field] = data
         object_ids = {x: object_ids[x] for x in object_ids if object_ids[x]}
-        create_kwargs = {x: create_kwargs[x] for x in create_kwargs if create_kwargs[x] != {}}
-        update_kwargs = {x: update_kwargs[x] for x in update_kwargs if update_kwargs[x] != {}}
         return object_ids, create_kwargs, update_kwargs
 
+    @classmethod
+    def kwargs_plan(cls):
+        # Compiled once per process: which (Object, field) each input heading
+        # feeds, so that parsing a record doesn't walk the models' fields again
+        if Object._kwargs_plan is None:
+            Object._kwargs_plan = KwargsPlan(Object.save_order())
+        return Object._kwargs_plan
+
     def iter_values_str(self):
         vals=self.values.values("signature__name", "data__pk", "signature__value_type__model")
         out_str = ""
@@ -287,7 +355,8 @@ class Object(models.Model):
         return type_counts
 
     @combomethod
-    def dataframe(receiver, wide=False, additional_fields=None, **kwargs):
+    def _dataframe_query(receiver, additional_fields=None, **kwargs):
+        # The Values, the fields to read off them, and which Objects they're read for
         if receiver.plural_name not in kwargs:
             if type(receiver) == models.base.ModelBase:
                 kwargs[receiver.plural_name] = receiver.objects.all()
@@ -319,13 +388,10 @@ class Object(models.Model):
     #    if 'exclude_types' in kwargs:
     #        exclude= {'signature__name__in': kwargs['exclude_types']}
     #        vals = vals.exclude(**exclude)
-        df = dpd.io.read_frame(vals, fieldnames=fieldnames, index_col=objs_names[0])
-        data = apps.get_model("db.Data").objects.filter(pk__in=df["data"]).get_real_instances()
-        values = {x.pk: x.get_value() for x in data}
-        df["data"] = df["data"].apply(lambda x: values[x])
-        if wide:
-            df = df.pivot_table(values="data",columns="signature__name", index=objs_names, aggfunc=lambda x: x)
-            df.columns = df.columns.rename("value_name")
+        return vals, fieldnames, objs_kwargs, objs_names
+
+    @staticmethod
+    def _rename_dataframe(df, objs_kwargs, wide=False):
         name_map = {"signature__name": "value_name",
                           "signature__value_type__model": "value_type",
                           "data": "value_data"}
@@ -335,6 +401,52 @@ class Object(models.Model):
             df.index = df.index.rename(objs_kwargs[0]+"_name")
         return df
 
+    @combomethod
+    def dataframe(receiver, wide=False, additional_fields=None, **kwargs):
+        vals, fieldnames, objs_kwargs, objs_names = receiver._dataframe_query(additional_fields=additional_fields, **kwargs)
+        df = apps.get_model("db.Data").value_frame(vals, fieldnames, index_col=objs_names[0])
+        if wide:
+            df = Object.pivot_wide(df, index=objs_names, columns="signature__name", values="data")
+            df.columns = df.columns.rename("value_name")
+        return Object._rename_dataframe(df, objs_kwargs, wide=wide)
+
+    @combomethod
+    def iter_dataframe(receiver, chunk_size=10000, additional_fields=None, **kwargs):
+        # Long-format dataframe() in chunks of at most chunk_size rows, read
+        # through a server-side cursor so memory stays bounded however many
+        # Values there are. Rows come in Value order, and every chunk has the
+        # same columns as dataframe()
+        vals, fieldnames, objs_kwargs, objs_names = receiver._dataframe_query(additional_fields=additional_fields, **kwargs)
+        for df in apps.get_model("db.Data").iter_value_frames(vals, fieldnames, index_col=objs_names[0], chunk_size=chunk_size):
+            yield Object._rename_dataframe(df, objs_kwargs)
+
+    @staticmethod
+    def pivot_wide(df, index, columns, values):
+        # Long to wide, one column per value name, built from the group codes
+        # instead of running a Python aggfunc per cell like pivot_table
+        # If an Object has more than one value under the same name, the first one fetched wins
+        # Each column gets its own dtype, so numeric metadata comes back as floats/ints
+        df = df.reset_index().dropna(subset=index)
+        groups = df.groupby(index, sort=True)
+        row_codes = groups.ngroup().to_numpy(dtype=np.int64)
+        rows = groups.size().index
+        col_codes, cols = pd.factorize(df[columns], sort=True)
+        if len(cols) == 0:
+            return pd.DataFrame(index=rows, columns=pd.Index([], name=columns))
+        data = df[values].to_numpy()
+        cells, first = np.unique(row_codes * len(cols) + col_codes, return_index=True)
+        cell_rows = cells // len(cols)
+        cell_cols = cells % len(cols)
+        wide = {}
+        for j, col in enumerate(cols):
+            in_col = cell_cols == j
+            # Objects without this value get NaN (or NaT), and ints become floats only if they have gaps
+            wide[col] = pd.Series(data[first[in_col]], index=cell_rows[in_col]).infer_objects().reindex(np.arange(len(rows)))
+        wide = pd.DataFrame(wide, columns=list(cols))
+        wide.index = rows
+        wide.columns = pd.Index(cols, name=columns)
+        return wide
+
     @combomethod
     def info(receiver):
         out_str = "Object type name: %s\n" % (receiver.base_name.capitalize(),)
@@ -344,7 +456,7 @@ class Object(models.Model):
                 out_str += "%s have upstream/downstream links to other %s\n" % (receiver.plural_name.capitalize(), receiver.plural_name)
             out_str += "There are %d %s in this QUOREM instance\n" % (receiver.objects.count(), receiver.plural_name)
         else:
-            out_str += "There are %d %s upstream of this one, and %d %s downstream of this one\n" % (receiver.all_upstream.count(), receiver.plural_name, receiver.all_downstream.count(), receiver.plural_name)
+            out_str += "There are %d %s upstream of this one, and %d %s downstream of this one\n" % (receiver.lineage(receiver.qs()).count(), receiver.plural_name, receiver.lineage(receiver.qs(), downstream=True).count(), receiver.plural_name)
             value_counts = ", ".join(["%d %s" % (vtype.objects.filter(pk__in=receiver.values.all()).count(), vtype.plural_name) for vtype in apps.get_model('db.Value').get_value_types()])
             out_str += "It has %d Values (%s)\n" % (receiver.values.count(), value_counts)
         return out_str
@@ -401,20 +513,118 @@ class Object(models.Model):
                 setattr(self, field, data)
                 save_required = True
             if field == "upstream":
-                for ref_obj in data:
-                    self.all_upstream.add(ref_obj)
-                    upstream_qs = ref_obj.all_upstream.all()
-                    downstream_qs = self.all_downstream.all()
-                    self.all_upstream.add(*upstream_qs)
-                    ref_obj.all_downstream.add(*downstream_qs)
-                    ref_obj.save()
-                    for down_obj in downstream_qs:
-                        for up_obj in upstream_qs:
-                            down_obj.all_upstream.add(up_obj)
-                        down_obj.save()
+                self.update_closure([(self.pk, ref_obj.pk) for ref_obj in data])
+                # Results infer their Step's upstream on save
+                save_required = True
+        if kwargs:
+            Object.bump_provenance_version({self._meta.model: [self.pk]})
         if save_required:
             self.save()
 
+    @classmethod
+    def update_closure(cls, edges):
+        # Brings the all_upstream cache up to date after the (downstream pk, upstream pk)
+        # edges were added to upstream. Every new closure pair is everything at or
+        # below the downstream end crossed with everything at or above the upstream
+        # end, which Postgres works out and inserts in one INSERT ... SELECT.
+        # Edges added together can chain through each other, so we repeat until
+        # nothing new goes in, which is once more than the longest such chain
+        if (not cls.has_upstream) or (cls.lineage_strategy() != "materialized"):
+            return
+        edges = [(down, up) for down, up in set([tuple(x) for x in edges]) if down != up]
+        if not edges:
+            return
+        field = cls._meta.get_field("all_upstream")
+        table = field.m2m_db_table()
+        src = field.m2m_column_name()
+        dst = field.m2m_reverse_name()
+        sql = """WITH edges(down, up) AS (SELECT * FROM unnest(%s::bigint[], %s::bigint[])),
+                      downs AS (SELECT down, up, down AS node FROM edges
+                                UNION SELECT e.down, e.up, c.{src} FROM edges e JOIN {table} c ON c.{dst} = e.down),
+                      ups AS (SELECT down, up, up AS node FROM edges
+                              UNION SELECT e.down, e.up, c.{dst} FROM edges e JOIN {table} c ON c.{src} = e.up)
+                 INSERT INTO {table} ({src}, {dst})
+                 SELECT DISTINCT d.node, u.node FROM downs d JOIN ups u ON d.down = u.down AND d.up = u.up
+                 WHERE d.node != u.node
+                 ON CONFLICT DO NOTHING""".format(table=connection.ops.quote_name(table),
+                                                  src=connection.ops.quote_name(src),
+                                                  dst=connection.ops.quote_name(dst))
+        downs, ups = [list(x) for x in zip(*edges)]
+        with connection.cursor() as cursor:
+            while True:
+                cursor.execute(sql, [downs, ups])
+                if cursor.rowcount <= 0:
+                    break
+        Object.bump_provenance_version({cls: downs + ups})
+
+    @classmethod
+    def rebuild_closure(cls):
+        # Recomputes all_upstream from scratch from the direct upstream edges,
+        # e.g. after running with the "recursive" lineage strategy for a while
+        if not cls.has_upstream:
+            return
+        field = cls._meta.get_field("all_upstream")
+        names = {"table": connection.ops.quote_name(field.m2m_db_table()),
+                 "src": connection.ops.quote_name(field.m2m_column_name()),
+                 "dst": connection.ops.quote_name(field.m2m_reverse_name())}
+        edges = cls._meta.get_field("upstream")
+        names.update({"edges": connection.ops.quote_name(edges.m2m_db_table()),
+                      "edge_src": connection.ops.quote_name(edges.m2m_column_name()),
+                      "edge_dst": connection.ops.quote_name(edges.m2m_reverse_name())})
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {table}".format(**names))
+            cursor.execute("""WITH RECURSIVE closure(src, dst) AS (
+                                  SELECT {edge_src}, {edge_dst} FROM {edges}
+                                  UNION SELECT c.src, e.{edge_dst} FROM closure c JOIN {edges} e ON e.{edge_src} = c.dst
+                              )
+                              INSERT INTO {table} ({src}, {dst}) SELECT src, dst FROM closure WHERE src != dst""".format(**names))
+
+    @staticmethod
+    def lineage_strategy():
+        # "materialized" reads the all_upstream cache, "recursive" walks the upstream edges on the fly
+        return getattr(settings, "LINEAGE_STRATEGY", "materialized")
+
+    @classmethod
+    def lineage(cls, objs, downstream=False, max_depth=None, strategy=None):
+        # Everything upstream (or downstream) of the objs QuerySet, not counting objs themselves
+        # max_depth limits how many upstream links away to look, which only the recursive strategy can do
+        if not cls.has_upstream:
+            return cls.objects.none()
+        if strategy is None:
+            strategy = cls.lineage_strategy()
+        if (strategy == "materialized") and (max_depth is None):
+            # The closure has no self pairs, but objs can still reach each other
+            return cls.objects.filter(pk__in=objs.values("all_downstream" if downstream else "all_upstream").distinct()).exclude(pk__in=objs.values("pk"))
+        field = cls._meta.get_field("upstream")
+        names = {"table": connection.ops.quote_name(field.m2m_db_table()),
+                 "src": connection.ops.quote_name(field.m2m_column_name()),
+                 "dst": connection.ops.quote_name(field.m2m_reverse_name())}
+        if downstream:
+            names["src"], names["dst"] = names["dst"], names["src"]
+        pks = list(objs.values_list("pk", flat=True))
+        # UNION (not UNION ALL) throws out rows we've already reached, so the walk
+        # stops on its own even if the graph has cycles. With a depth limit the
+        # rows carry their depth, and the limit is what stops it
+        if max_depth is None:
+            sql = """WITH RECURSIVE lineage(node) AS (
+                         SELECT {dst} FROM {table} WHERE {src} = ANY(%s::bigint[])
+                         UNION SELECT e.{dst} FROM lineage l JOIN {table} e ON e.{src} = l.node
+                     )
+                     SELECT node FROM lineage WHERE NOT node = ANY(%s::bigint[])"""
+            params = [pks, pks]
+        else:
+            sql = """WITH RECURSIVE lineage(node, depth) AS (
+                         SELECT {dst}, 1 FROM {table} WHERE {src} = ANY(%s::bigint[])
+                         UNION SELECT e.{dst}, l.depth + 1 FROM lineage l JOIN {table} e ON e.{src} = l.node
+                         WHERE l.depth < %s
+                     )
+                     SELECT DISTINCT node FROM lineage WHERE NOT node = ANY(%s::bigint[])"""
+            params = [pks, max_depth, pks]
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(**names), params)
+            lineage_pks = [x[0] for x in cursor.fetchall()]
+        return cls.objects.filter(pk__in=lineage_pks)
+
     @classmethod
     def get_or_create(cls, name, **kwargs):
         objs = cls.get(name)
@@ -433,15 +643,26 @@ class Object(models.Model):
         value_type = apps.get_model("db.Value").get_value_types(type_name=value_name)
         return cls.plural_name in value_type.linkable_objects
 
+    @staticmethod
+    def type_registry():
+        return registry_for(Object, Object.__subclasses__, lambda Obj: [Obj.base_name, Obj.plural_name])
+
     @classmethod
-    def get_object_types(cls, type_name=None):
+    def get_object_types(cls, type_name=None, ctype=None):
+        if cls is not Object:
+            return cls.__subclasses__() if type_name is None else Object.get_object_types(type_name=type_name)
+        registry = Object.type_registry()
+        if ctype is not None:
+            Obj = registry.from_ctype(ctype)
+            if Obj is None:
+                raise ValueError("Unknown Object ContentType %s" % (ctype,))
+            return Obj
         if type_name == None:
-            return cls.__subclasses__()
-        else:
-            for Obj in cls.__subclasses__():
-                if (type_name.lower() == Obj.base_name) or (type_name.lower() == Obj.plural_name):
-                    return Obj
+            return list(registry)
+        Obj = registry.get(type_name)
+        if Obj is None:
             raise ValueError("Unknown Object %s" % (type_name,))
+        return Obj
 
     @classmethod
     def get_queryset(cls, data):
@@ -468,7 +689,7 @@ class Object(models.Model):
     def get_upstream_values(self):
         if not self.has_upstream:
             return apps.get_model("db", "Value").objects.none()
-        upval_pks = self.all_upstream.prefetch_related("values")
+        upval_pks = self.lineage(self.qs())
         return apps.get_model("db", "Value").objects.filter(pk__in=upval_pks.values("values"))
 
     # Default search methods, using only internal methods
@@ -476,7 +697,7 @@ class Object(models.Model):
     def related_samples(self, upstream=False):
         samples = apps.get_model("db", "Sample").objects.filter(source_step__in=self.related_steps(upstream=upstream)).distinct()
         if upstream:
-            samples = samples | apps.get_model("db", "Sample").objects.filter(pk__in=samples.values("all_upstream").distinct())
+            samples = samples | apps.get_model("db", "Sample").lineage(samples)
         return samples
 
     def related_samples_count(self, upstream=False):
@@ -485,7 +706,7 @@ class Object(models.Model):
     def related_processes(self, upstream=False):
         processes = apps.get_model("db", "Process").objects.filter(pk__in=self.related_steps(upstream=upstream).values("processes").distinct())
         if upstream:
-            processes = processes | apps.get_model("db", "Process").objects.filter(pk__in=processes.values("all_upstream").distinct())
+            processes = processes | apps.get_model("db", "Process").lineage(processes)
         return processes
 
     def related_features(self):
@@ -500,7 +721,7 @@ class Object(models.Model):
         # Return the source_step for each sample
         steps = apps.get_model("db", "Step").objects.filter(pk__in=self.related_samples(upstream=upstream).values("source_step").distinct())
         if upstream:
-            steps = steps | apps.get_model("db", "Step").objects.filter(pk__in=steps.values("all_upstream").distinct())
+            steps = steps | apps.get_model("db", "Step").lineage(steps)
         return steps
 
     def related_analyses(self):
@@ -514,7 +735,7 @@ class Object(models.Model):
     def related_results(self, upstream=False):
         results = apps.get_model("db", "Result").objects.filter(samples__in=self.related_samples(upstream=upstream)).distinct()
         if upstream:
-            results = results | apps.get_model("db", "Result").objects.filter(pk__in=results.values("all_upstream").distinct())
+            results = results | apps.get_model("db", "Result").lineage(results)
         return results
 
     def related_investigations(self):
@@ -558,7 +779,7 @@ class Object(models.Model):
         kwargs[self.base_name + "_id"] = self.pk
         return reverse(lookup, kwargs=kwargs)
 
-    def get_node_attrs(self, show_values=True, highlight=False, value_counts=None):
+    def get_node_attrs(self, show_values=True, highlight=False, value_counts=None, descriptions=None):
         htm = "<<table border=\"0\"><tr><td colspan=\"2\"><b>%s</b></td></tr>" % (self.base_name.upper(),)
         if not show_values:
            sep = ""
@@ -577,10 +798,11 @@ class Object(models.Model):
                 htm += "<tr><td border=\"1\" bgcolor=\"#ffffff\">%s</td>" % (vtype.capitalize(),)
                 htm += "<td border=\"1\" bgcolor=\"#ffffff\">%d</td></tr>" % (count,)
             if ('description' in val_counts) and (val_counts['description'] >= 0):
-                descriptions = self.values.instance_of(apps.get_model("db.Description"))
+                if descriptions is None:
+                    descriptions = [descrip.data.get().get_value() for descrip in self.values.instance_of(apps.get_model("db.Description"))]
                 htm+="<tr><td colspan=\"2\">Description</td></tr>"
                 for descrip in descriptions:
-                    htm+="<tr><td border=\"1\" colspan=\"2\"><i>%s</i></td></tr>" % ("<BR/>".join(wrap(descrip.data.get().get_value(), width=70)),)
+                    htm+="<tr><td border=\"1\" colspan=\"2\"><i>%s</i></td></tr>" % ("<BR/>".join(wrap(descrip, width=70)),)
         htm += "</table>>"
         attrs = self.gv_node_style.copy()
         attrs["name"] = str(self.pk)
@@ -604,29 +826,127 @@ class Object(models.Model):
         dot.node(**self.get_node_attrs(show_values=show_values, highlight=highlight))
         return dot
 
+    def provenance_neighbours(self):
+        # One node of the provenance graph, its immediate upstream and downstream
+        # neighbours, and enough about each (value counts, how many neighbours
+        # they have in turn) for a client to decide what to expand next
+        # This is a handful of indexed queries no matter how big the lineage is
+        Obj = self._meta.model
+        if not self.has_upstream:
+            return {"node": self.provenance_summary(), "upstream": [], "downstream": []}
+        upstream_pks = set(self.upstream.values_list("pk", flat=True))
+        downstream_pks = set(self.downstream.values_list("pk", flat=True))
+        objs = Obj.objects.filter(pk__in=upstream_pks | downstream_pks | {self.pk})
+        objs = objs.annotate(n_upstream=models.Count("upstream", distinct=True),
+                             n_downstream=models.Count("downstream", distinct=True))
+        value_counts = Obj.get_value_counts(queryset=Obj.objects.filter(pk__in=upstream_pks | downstream_pks | {self.pk}))
+        summaries = {obj.pk: obj.provenance_summary(value_counts=value_counts.get(obj.pk, {})) for obj in objs}
+        return {"node": summaries[self.pk],
+                "upstream": [summaries[pk] for pk in sorted(upstream_pks)],
+                "downstream": [summaries[pk] for pk in sorted(downstream_pks)]}
+
+    def provenance_summary(self, value_counts=None):
+        if value_counts is None:
+            value_counts = self.get_value_counts().get(self.pk, {})
+        summary = {"id": self.pk,
+                   "type": self.base_name,
+                   "name": str(getattr(self, self.id_field)),
+                   "url": reverse(self.base_name + "_detail", kwargs={self.base_name + "_id": self.pk}),
+                   "value_counts": dict(value_counts)}
+        if self.has_upstream:
+            # Annotated by provenance_neighbours, otherwise counted here
+            summary["n_upstream"] = self.n_upstream if hasattr(self, "n_upstream") else self.upstream.count()
+            summary["n_downstream"] = self.n_downstream if hasattr(self, "n_downstream") else self.downstream.count()
+        return summary
+
+    # Rendered graphs are cached against a provenance version per Object, which
+    # is bumped whenever an upstream link or a Value of anything in its lineage
+    # changes. It lives in the shared cache, so a bump from a celery worker
+    # reaches the web processes
+    graph_cache_timeout = 60*60*24
+
+    @staticmethod
+    def provenance_version_key(Obj, pk):
+        return "quorem:provenance_version:%s:%d" % (Obj.base_name, pk)
+
+    def provenance_version(self):
+        # Starts from the clock, so a version that was evicted or bumped never
+        # comes back at a value that graphs were already cached against
+        return cache.get_or_set(self.provenance_version_key(self._meta.model, self.pk), time.time_ns, timeout=None)
+
+    @staticmethod
+    def bump_provenance_version(objs):
+        # objs maps Object types (or their plural names) to the pks whose Values or
+        # upstream links changed. They and their lineage are bumped together, once
+        # per transaction when it commits: nothing is visible to other processes
+        # before that, and a rollback has nothing to invalidate
+        bump = None
+        if connection.in_atomic_block:
+            bump = next((x[1] for x in connection.run_on_commit if isinstance(x[1], ProvenanceBump)), None)
+        if bump is None:
+            bump = ProvenanceBump()
+            if connection.in_atomic_block:
+                transaction.on_commit(bump)
+        for Obj, pks in objs.items():
+            if isinstance(Obj, str):
+                Obj = Object.get_object_types(type_name=Obj)
+            bump.pks[Obj].update(pks)
+        if not connection.in_atomic_block:
+            bump()
+
+    def cached_svg(self, kind, render, **kwargs):
+        # SVG text of render(**kwargs), laid out by graphviz only on a cache miss
+        key = "quorem:graph:%s:%s:%d:%s:%d" % (kind, self.base_name, self.pk,
+                                               ",".join(["%s=%s" % (x, kwargs[x]) for x in sorted(kwargs)]),
+                                               self.provenance_version())
+        svg = cache.get(key)
+        if svg is None:
+            svg = render(**kwargs).pipe().decode()
+            cache.set(key, svg, timeout=self.graph_cache_timeout)
+        return svg
+
+    def stream_graph_svg(self, show_values=False):
+        return self.cached_svg("stream", self.get_stream_graph, show_values=show_values)
+
     def get_stream_graph(self, show_values=False, format='svg'):
+        # Everything is fetched up front in a fixed number of queries (the node
+        # set, the upstream links among those nodes, and their value counts and
+        # descriptions), and only then laid out
         dot = gv.Digraph("streamgraph_%s_%d" % (self.base_name, self.pk), format=format)
         origin = self
-        dot.node(**origin.get_node_attrs(show_values=show_values, highlight=True))
+        Obj = self._meta.model
+        pks = set(Obj.lineage(origin.qs()).values_list("pk", flat=True))
+        pks.update(Obj.lineage(origin.qs(), downstream=True).values_list("pk", flat=True))
+        pks.add(origin.pk)
+        nodes = {obj.pk: obj for obj in Obj.objects.filter(pk__in=pks)}
+        upstream_field = Obj._meta.get_field("upstream")
+        through = upstream_field.remote_field.through
+        down_col = upstream_field.m2m_field_name()
+        up_col = upstream_field.m2m_reverse_field_name()
         edges = set()
-        for us_pk in origin.upstream.values_list("pk", flat=True):
-            edges.add((str(us_pk), str(origin.pk)))
-        for ds_pk in origin.downstream.values_list("pk", flat=True):
-            edges.add((str(origin.pk), str(ds_pk)))
-        upstream = origin.all_upstream.prefetch_related("upstream", "downstream")
-        downstream = origin.all_downstream.prefetch_related("upstream", "downstream")
-        both = upstream | downstream
-        nnodes = len(both)+1
-        all_pks = both.values_list("pk",flat=True)
-        for obj in both:
-            attrs = obj.get_node_attrs(show_values=show_values, value_counts=obj.get_value_counts()[obj.pk])
-            dot.node(**attrs)
-            for us_pk in obj.upstream.values_list("pk", flat=True):
-                if us_pk in all_pks:
-                    edges.add((str(us_pk), str(obj.pk)))
-            for ds_pk in obj.downstream.values_list("pk", flat=True):
-                if ds_pk in all_pks:
-                    edges.add((str(obj.pk), str(ds_pk)))
+        for ds_pk, us_pk in through.objects.filter(**{down_col + "__in": pks, up_col + "__in": pks}).values_list(down_col + "_id", up_col + "_id"):
+            edges.add((str(us_pk), str(ds_pk)))
+        value_counts = {}
+        descriptions = defaultdict(list)
+        if show_values:
+            value_counts = Obj.get_value_counts(queryset=Obj.objects.filter(pk__in=pks))
+            described = [pk for pk in pks if "description" in value_counts.get(pk, {})]
+            if described:
+                Description = apps.get_model("db.Description")
+                descrips = Description.objects.filter(**{Obj.plural_name + "__in": described}).prefetch_related("data")
+                links = Description.objects.filter(pk__in=descrips).values_list("pk", Obj.plural_name)
+                descrips = {descrip.pk: descrip for descrip in descrips}
+                for descrip_pk, pk in links:
+                    if pk in described:
+                        descriptions[pk].extend([datum.get_value() for datum in descrips[descrip_pk].data.all()])
+        def node_attrs(obj, highlight=False):
+            return obj.get_node_attrs(show_values=show_values, highlight=highlight,
+                                      value_counts=value_counts.get(obj.pk, {}),
+                                      descriptions=descriptions[obj.pk])
+        dot.node(**node_attrs(nodes[origin.pk], highlight=True))
+        for pk, obj in nodes.items():
+            if pk != origin.pk:
+                dot.node(**node_attrs(obj))
         dot.edges(list(edges))
         dot.attr(ratio="0.5")
         return dot
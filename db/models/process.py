@@ -79,7 +79,7 @@ class Process(Object):
     def related_steps(self, upstream=False):
         steps = self.steps.all()
         if upstream:
-            steps = steps | apps.get_model("db", "Step").objects.filter(pk__in=steps.values("all_upstream").distinct())
+            steps = steps | apps.get_model("db", "Step").lineage(steps)
         return steps
 
     def related_analyses(self):
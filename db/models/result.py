@@ -41,6 +41,8 @@ class Result(Object):
     all_upstream = models.ManyToManyField('self', symmetrical=False, related_name='all_downstream', blank=True)
 
     values = models.ManyToManyField('Value', related_name="results", blank=True)
+    # sha256 of the QIIME2 action.yaml this Result was ingested from, so shared provenance is only ingested once
+    provenance_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True)
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
@@ -278,7 +280,7 @@ class Result(Object):
     def related_samples(self, upstream=False):
         samples = self.samples.all()
         if upstream:
-            samples = samples | apps.get_model("db", "Sample").objects.filter(pk__in=self.samples.values("all_upstream").distinct())
+            samples = samples | apps.get_model("db", "Sample").lineage(self.samples.all())
         return samples
 
     def related_features(self):
@@ -289,13 +291,13 @@ class Result(Object):
             return apps.get_model("db", "Step").objects.none()
         steps = apps.get_model("db", "Step").objects.filter(pk=self.source_step.pk)
         if upstream:
-            steps = steps | apps.get_model("db", "Step").objects.filter(pk__in=steps.values("all_upstream").distinct())
+            steps = steps | apps.get_model("db", "Step").lineage(steps)
         return steps
 
     def related_processes(self, upstream=False):
         processes = apps.get_model("db", "Process").objects.filter(pk=self.analysis.process.pk)
         if upstream:
-            processes = processes | apps.get_model("db", "Process").objects.filter(pk__in=processes.values("all_upstream").distinct())
+            processes = processes | apps.get_model("db", "Process").lineage(processes)
         return processes
 
     def related_analyses(self):
@@ -369,6 +371,9 @@ class Result(Object):
         attrs['fillcolor'] = col.hex_l
         return attrs
 
+    def simple_provenance_svg(self):
+        return self.cached_svg("simple_provenance", self.simple_provenance_graph)
+
     def simple_provenance_graph(self):
         dot = gv.Digraph("provenance", format='svg')
         dot.graph_attr.update(compound='true')
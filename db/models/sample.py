@@ -55,14 +55,14 @@ class Sample(Object):
     def related_steps(self, upstream=False):
         steps = apps.get_model("db", "Step").objects.filter(pk=self.source_step.pk)
         if upstream:
-            steps = steps | apps.get_model("db", "Step").objects.filter(pk__in=steps.values("all_upstream").distinct())
+            steps = steps | apps.get_model("db", "Step").lineage(steps)
         return steps
 
     def related_results(self, upstream=False):
         # SQL Depth: 1
         results = self.results.all()
         if upstream:
-            results = results | apps.get_model("db", "Result").objects.filter(pk__in=results.values("all_upstream").distinct())
+            results = results | apps.get_model("db", "Result").lineage(results)
         return results.distinct()
 
     def html_features(self):
@@ -55,13 +55,13 @@ class Step(Object):
     def related_samples(self, upstream=False):
         samples = apps.get_model("db", "Sample").objects.filter(source_step__pk=self.pk)
         if upstream:
-            samples = samples | apps.get_model("db", "Sample").objects.filter(pk__in=self.samples.values("all_upstream").distinct())
+            samples = samples | apps.get_model("db", "Sample").lineage(self.samples.all())
         return samples
 
     def related_processes(self, upstream=False):
         processes = self.processes.all()
         if upstream:
-            processes = processes | apps.get_model("db", "Process").objects.filter(pk__in=processes.values("all_upstream").distinct())
+            processes = processes | apps.get_model("db", "Process").lineage(processes)
         return processes
 
     def related_analyses(self):
@@ -73,5 +73,5 @@ class Step(Object):
         # Results ejected from this step
         results = apps.get_model("db", "Result").objects.filter(source_step__pk=self.pk)
         if upstream:
-            results = results | apps.get_model("db", "Result").objects.filter(pk__in=results.values("all_upstream").distinct())
+            results = results | apps.get_model("db", "Result").lineage(results)
         return results
@@ -1,4 +1,5 @@
 from collections import defaultdict, OrderedDict
+from functools import partial
 import itertools
 
 from django.db import models, transaction
@@ -20,6 +21,8 @@ import uuid
 
 from .data_types import Data, DataSignature
 from .object import Object
+from ..registry import registry_for
+from ..postgres import advisory_lock, bulk_create_polymorphic
 from .step import Step
 from .result import Result
 from .analysis import Analysis
@@ -116,14 +119,19 @@ class Value(PolymorphicModel):
         if "data_type" in kwargs:
             newkwargs["data_type"] = kwargs["data_type"]
         vobj_keys = [x for x in kwargs if x.startswith("value_object")]
+        if vobj_keys:
+            # Group the id columns by heading in one pass, e.g., sample_name.0, sample_name.1, ...
+            stems = defaultdict(list)
+            for arg in kwargs:
+                stems[arg.split(".")[0]].append(kwargs[arg])
         for vobj_key in vobj_keys:
             vobj = Object.get_object_types(type_name=kwargs[vobj_key])
+            if vobj.plural_name in newkwargs:
+                continue # Same Object type named twice
             if (vobj.plural_name in kwargs) and (type(kwargs[vobj.plural_name]) in [models.query.QuerySet, DataFrameQuerySet]):
                 continue # We already have it in QS format
-            qsdata = defaultdict(list)
-            for arg in kwargs:
-                if arg.split(".")[0] == vobj.base_name+"_"+vobj.id_field:
-                    qsdata[arg.split(".")[0]].append(kwargs[arg])
+            heading = vobj.base_name + "_" + vobj.id_field
+            qsdata = {heading: stems[heading]} if heading in stems else {}
             vobjs = vobj.get_queryset(qsdata)
             newkwargs[vobj.plural_name] = vobjs
         if fetch_signature:
@@ -131,16 +139,25 @@ class Value(PolymorphicModel):
             newkwargs["signature"] = signature
         return newkwargs
 
+    @staticmethod
+    def type_registry():
+        return registry_for(Value, lambda: Value.__subclasses__() + [Value], lambda val: [val.base_name, val.plural_name])
+
     @classmethod
-    def get_value_types(cls, name=None, data=None, type_name=None, data_types=False, **kwargs):
+    def get_value_types(cls, name=None, data=None, type_name=None, data_types=False, ctype=None, **kwargs):
+        if ctype is not None:
+            val = Value.type_registry().from_ctype(ctype)
+            if val is None:
+                raise ValueError("Unknown Value ContentType %s" % (ctype,))
+            return val
         if (name is None) and (type_name) is None:
-            return cls.__subclasses__() + [Value]
+            if cls is not Value:
+                return cls.__subclasses__() + [Value]
+            return list(Value.type_registry())
         elif type_name is not None:
-            if type_name.lower() == "value":
-                return Value
-            for val in Value.get_value_types():
-                if (val.base_name == type_name.lower()) or (val.plural_name == type_name.lower()):
-                    return val
+            val = Value.type_registry().get(type_name)
+            if val is not None:
+                return val
         object_counts = {}
         for Obj in Object.get_object_types():
             if Obj.plural_name in kwargs:
@@ -162,6 +179,13 @@ class Value(PolymorphicModel):
         cls.objects.update(
             search_vector= (SearchVector('signature__name', weight='A')))
 
+    @classmethod
+    def bulk_safe(cls, objects):
+        # Whether a Value of this type linked to these Objects (plural names) can go
+        # through bulk_create(), which only does what the plain get_or_create() does
+        # Types whose get_or_create does more override this
+        return True
+
     @classmethod
     def _clean_value_type(cls, **kwargs):
         if "value_type" not in kwargs:
@@ -203,14 +227,14 @@ class Value(PolymorphicModel):
         if 'data_type' in kwargs:
             data_type = kwargs['data_type']
             if data_type == "auto":
-                data_type = Data.infer_type(data)
+                data_type = Data.infer_type(data, signature=signature.pk)
             else:
                 data_type = Data.get_data_types(type_name=data_type)
             add_dtype_to_signature = True
         elif signature.data_types.exists():
             data_type = signature.data_types.first().model_class() #TODO; Allow users to select a preferred default
         else:
-            data_type = Data.infer_type(data)
+            data_type = Data.infer_type(data, signature=signature.pk)
             add_dtype_to_signature = True
         data = data_type.get_or_create(data)
         value = kwargs["value_type"]()
@@ -220,12 +244,213 @@ class Value(PolymorphicModel):
         if add_dtype_to_signature:
             ct = ContentType.objects.get_for_model(data_type)
             signature.data_types.add(ct)
+        linked = {}
         for Obj in Object.get_object_types():
             if Obj.plural_name in kwargs:
                 for obj in kwargs[Obj.plural_name]:
                     obj.values.add(value)
+                linked[Obj] = [obj.pk for obj in kwargs[Obj.plural_name]]
+        Object.bump_provenance_version(linked)
         return value
 
+    @classmethod
+    def bulk_create(cls, records, skip_existing=False, errors=None, batch_size=5000, lock=False):
+        # create() for many Values at once
+        # records are dicts with "name" and "data", optionally "value_type" and
+        # "data_type" as in create(), and the pks of the linked Objects under
+        # their plural names, e.g., {"name": "depth", "data": 5, "samples": [1, 2]}
+        # Signatures, Data, the Value rows and all of their links are written
+        # with a few bulk queries per batch, instead of ~10 queries per Value
+        # With skip_existing, records that get() would find are left alone, like get_or_create(),
+        # including ones that would find a Value made for an earlier record in the same call
+        # With an errors list, records that fail validation or casting are appended
+        # to it as (record, exception) and skipped, instead of raising
+        # With lock, new signatures and Data are advisory-locked and looked up
+        # again before they're created, for when other transactions may create them too
+        # Returns the new Values' pks in the order of records, None for any not created
+        object_types = Object.get_object_types()
+        pks = [None] * len(records)
+        def fail(i, e):
+            if errors is None:
+                raise e
+            errors.append((records[i], e))
+        # Validate, and work out each record's signature key
+        parsed = {}
+        for i, record in enumerate(records):
+            try:
+                valClass = cls._clean_value_type(**record)
+                links = {}
+                for Obj in object_types:
+                    if Obj.plural_name in record:
+                        objs = record[Obj.plural_name]
+                        if type(objs) in [models.query.QuerySet, DataFrameQuerySet]:
+                            objs = objs.values_list("pk", flat=True)
+                        links[Obj.plural_name] = sorted(set([int(x) for x in objs]))
+                for obj in valClass.required_objects:
+                    if Object.get_object_types(type_name=obj).plural_name not in links:
+                        raise ValueError("Missing required links to %s for value %s" % (obj, record["name"]))
+                for obj in links:
+                    if obj not in valClass.linkable_objects:
+                        raise ValueError("Cannot link %s to Values of type %s" % (obj, valClass.__name__))
+                if not valClass.bulk_safe(links.keys()):
+                    raise ValueError("%s linked to %s have to go through get_or_create()" % (valClass.__name__, ", ".join(links)))
+                counts = tuple([len(links.get(Obj.plural_name, [])) for Obj in object_types])
+                parsed[i] = (valClass, record["name"], counts, links)
+            except Exception as e:
+                fail(i, e)
+        if not parsed:
+            return pks
+        # Signatures, matched on the counts of linked Objects as in DataSignature.get()
+        signatures = {}
+        ambiguous = set()
+        for valClass in set([x[0] for x in parsed.values()]):
+            ctype = ContentType.objects.get_for_model(valClass)
+            keys = set([(name, counts) for vc, name, counts, links in parsed.values() if vc == valClass])
+            # From the signature cache, only asking the database about keys it
+            # has no match for, which may have been made earlier in this transaction
+            def matches(sigs, counts):
+                object_counts = dict(zip([Obj.plural_name for Obj in object_types], counts))
+                return [sig for sig in sigs if all([sig.object_counts.get(k) == v for k, v in object_counts.items()])]
+            cached = DataSignature.cached_signatures()
+            candidates = defaultdict(list)
+            for name in set([name for name, counts in keys]):
+                candidates[name].extend(cached.get((name, ctype.pk), []))
+            uncached = set([name for name, counts in keys if not matches(candidates[name], counts)])
+            if uncached:
+                for sig in DataSignature.objects.filter(name__in=uncached, value_type=ctype):
+                    if sig.pk not in [x.pk for x in candidates[sig.name]]:
+                        candidates[sig.name].append(sig)
+            missing = set([name for name, counts in keys if not matches(candidates[name], counts)])
+            if missing and lock:
+                advisory_lock("signatures", [DataSignature.lock_name(valClass, name) for name in missing])
+                for sig in DataSignature.objects.filter(name__in=missing, value_type=ctype):
+                    if sig.pk not in [x.pk for x in candidates[sig.name]]:
+                        candidates[sig.name].append(sig)
+            new_sigs = []
+            for name, counts in keys:
+                found = matches(candidates[name], counts)
+                if len(found) == 1:
+                    signatures[(valClass, name, counts)] = found[0]
+                elif len(found) > 1:
+                    ambiguous.add((valClass, name, counts))
+                else:
+                    new_sigs.append(DataSignature(name=name, value_type=ctype, object_counts=dict(zip([Obj.plural_name for Obj in object_types], counts))))
+            new_sigs = DataSignature.objects.bulk_create(new_sigs, batch_size=batch_size)
+            for sig in new_sigs:
+                signatures[(valClass, sig.name, tuple([sig.object_counts[Obj.plural_name] for Obj in object_types]))] = sig
+            if new_sigs:
+                # bulk_create doesn't send post_save
+                transaction.on_commit(partial(DataSignature.signatures_committed, new_sigs))
+        for i, (valClass, name, counts, links) in list(parsed.items()):
+            if (valClass, name, counts) in ambiguous:
+                del parsed[i]
+                fail(i, ValueError("Multiple DataSignatures found. Provide n_<objects> arguments in kwargs to resolve the ambiguity, or provide the signature explicitly"))
+        sig_pks = set([sig.pk for sig in signatures.values()])
+        if skip_existing:
+            # The Values under these signatures that are linked to these Objects,
+            # a record is found if it shares a Value across every Object type it links to
+            linked = defaultdict(set)
+            for Obj in object_types:
+                obj_pks = set([pk for vc, name, counts, links in parsed.values() for pk in links.get(Obj.plural_name, [])])
+                if not obj_pks:
+                    continue
+                through = Obj.values.through
+                source = Obj.values.field.m2m_field_name()
+                for obj_pk, value_pk, sig_pk in through.objects.filter(**{source + "__in": obj_pks, "value__signature__in": sig_pks}).values_list(source + "_id", "value_id", "value__signature"):
+                    linked[(sig_pk, Obj.plural_name, obj_pk)].add(value_pk)
+            used = set(DataSignature.values.through.objects.filter(datasignature__in=sig_pks).values_list("datasignature", flat=True).distinct())
+            for i, (valClass, name, counts, links) in list(parsed.items()):
+                if valClass == Matrix:
+                    continue # As in get_or_create(), Matrices are always created
+                sig = signatures[(valClass, name, counts)]
+                if not links:
+                    if sig.pk in used:
+                        del parsed[i]
+                    continue
+                found = None
+                for obj, obj_pks in links.items():
+                    vals = set().union(*[linked[(sig.pk, obj, pk)] for pk in obj_pks])
+                    found = vals if found is None else found & vals
+                if found:
+                    del parsed[i]
+        # Data types, as create() picks them
+        sig_types = defaultdict(list)
+        for sig_pk, ct_pk in DataSignature.data_types.through.objects.filter(datasignature__in=sig_pks).values_list("datasignature", "contenttype"):
+            sig_types[sig_pk].append(ct_pk)
+        data = {}
+        type_links = set()
+        for i, (valClass, name, counts, links) in list(parsed.items()):
+            record = records[i]
+            sig = signatures[(valClass, name, counts)]
+            try:
+                if "data_type" in record:
+                    if record["data_type"] == "auto":
+                        data_type = Data.infer_type(record["data"], signature=sig.pk)
+                    else:
+                        data_type = Data.get_data_types(type_name=record["data_type"])
+                    type_links.add((sig.pk, data_type))
+                elif sig_types[sig.pk]:
+                    data_type = Data.get_data_types(ctype=sig_types[sig.pk][0])
+                else:
+                    data_type = Data.infer_type(record["data"], signature=sig.pk)
+                    type_links.add((sig.pk, data_type))
+                try:
+                    casted = data_type.cast(record["data"])
+                except:
+                    raise ValueError("Cannot parse value %s with cast function for data type %s" % (str(record["data"]), data_type.type_name))
+                data[i] = (data_type, casted)
+            except Exception as e:
+                del parsed[i]
+                fail(i, e)
+        # Data, reusing any Datum that already holds the value
+        datum_pks = {}
+        for data_type in set([x[0] for x in data.values()]):
+            idx = [i for i in data if data[i][0] == data_type]
+            found = data_type.get_or_create_many([records[i]["data"] for i in idx], batch_size=batch_size,
+                                                 casted=[data[i][1] for i in idx], lock=lock)
+            datum_pks.update(zip(idx, found))
+        # Repeated records become a single Value, the first one's. With skip_existing
+        # that's any with the same signature and Objects, which is what get_or_create()
+        # one record at a time would find, otherwise only those with the same Datum too
+        # Matrices are always created, as in get_or_create()
+        firsts, repeats = {}, {}
+        for i, (valClass, name, counts, links) in list(parsed.items()):
+            if (valClass == Matrix) or (i not in datum_pks):
+                continue
+            key = (signatures[(valClass, name, counts)].pk, tuple(sorted([(obj, tuple(obj_pks)) for obj, obj_pks in links.items()])))
+            if not skip_existing:
+                key += (datum_pks[i],)
+            if key in firsts:
+                repeats[i] = firsts[key]
+                del parsed[i]
+            else:
+                firsts[key] = i
+        # The Values themselves, and their links
+        for valClass in set([x[0] for x in parsed.values()]):
+            idx = [i for i in parsed if parsed[i][0] == valClass]
+            for i, val in zip(idx, bulk_create_polymorphic(valClass, [valClass() for i in idx], batch_size=batch_size)):
+                pks[i] = val.pk
+        for i, first in repeats.items():
+            pks[i] = pks[first]
+        sig_links, data_links = [], []
+        obj_links = defaultdict(list)
+        for i, (valClass, name, counts, links) in parsed.items():
+            sig_links.append(DataSignature.values.through(datasignature_id=signatures[(valClass, name, counts)].pk, value_id=pks[i]))
+            data_links.append(Data.values.through(data_id=datum_pks[i], value_id=pks[i]))
+            for obj, obj_pks in links.items():
+                Obj = Object.get_object_types(type_name=obj)
+                source = Obj.values.field.m2m_field_name()
+                obj_links[Obj].extend([Obj.values.through(**{source + "_id": pk, "value_id": pks[i]}) for pk in obj_pks])
+        type_links = [DataSignature.data_types.through(datasignature_id=sig_pk, contenttype_id=ContentType.objects.get_for_model(data_type).pk) for sig_pk, data_type in type_links]
+        for through, links in [(DataSignature.values.through, sig_links),
+                               (Data.values.through, data_links),
+                               (DataSignature.data_types.through, type_links)] + \
+                              [(Obj.values.through, links) for Obj, links in obj_links.items()]:
+            through.objects.bulk_create(links, batch_size=batch_size, ignore_conflicts=True)
+        Object.bump_provenance_version({Obj: [getattr(link, Obj.values.field.m2m_field_name() + "_id") for link in links]
+                                        for Obj, links in obj_links.items()})
+        return pks
+
     def get_links(self, return_querysets=False):
         #Since this is the back side of these relationships, this should be quickest?
         linked_objects = []
@@ -302,6 +527,13 @@ class Parameter(Value):
                 parameters = parameters.filter(**{objs+"__isnull": True})
         return parameters
 
+    @classmethod
+    def bulk_safe(cls, objects):
+        # Parameters are found through their Step, at the most specific level
+        # linked. A Step's own defaults link nothing else, so the signature
+        # (one Step, nothing else) already pins them down the way get() would
+        return set(objects) == set(["steps"])
+
     @classmethod
     def get_or_create(cls, name, data, **kwargs):
         assert "steps" in kwargs, "'steps' keyword must be provided to get a Parameter"
@@ -13,11 +13,18 @@ from .models import *
 
 
 def pcoa_plot(countmatrix_pk, measure='braycurtis', metadata_colour=None, plot_height=750, three_dimensional=False):
-    count_matrix_result = Result.objects.get(pk=countmatrix_pk)
-    count_matrix = count_matrix_result.values.instance_of(Matrix).first().data.get().get_value()
-    count_matrix = count_matrix.loc[:, (count_matrix != 0).any(axis=0)]
-    pcoa = skbio.stats.ordination.pcoa(skbio.diversity.beta_diversity(measure, count_matrix.T))
-    pcoa.samples.index = count_matrix.T.index
+    # Results that already store a distance matrix (e.g., QIIME2 beta diversity) are used as-is
+    distance_matrix = DistanceMatrixDatum.objects.filter(values__results__pk=countmatrix_pk).first()
+    if distance_matrix is not None:
+        distance_matrix = distance_matrix.get_value()
+        measure = "precomputed"
+    else:
+        count_matrix_result = Result.objects.get(pk=countmatrix_pk)
+        count_matrix = count_matrix_result.values.instance_of(Matrix).first().data.get().get_value()
+        count_matrix = count_matrix.loc[:, (count_matrix != 0).any(axis=0)]
+        distance_matrix = skbio.diversity.beta_diversity(measure, count_matrix.T)
+    pcoa = skbio.stats.ordination.pcoa(distance_matrix)
+    pcoa.samples.index = list(distance_matrix.ids)
     plot_kwargs = {}
     if metadata_colour != None and metadata_colour != '':
         try:
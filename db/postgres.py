@@ -1,3 +1,7 @@
+import hashlib
+
+from django.db import connection
+from django.contrib.contenttypes.models import ContentType
 from django.db.models.expressions import F, Value as BaseValue, Func, Expression
 
 class V(BaseValue):
@@ -23,3 +27,49 @@ class ArrayPositions(SimpleFunc):
     
 class Unnest(Func):
     function = 'UNNEST'
+
+def advisory_lock(namespace, names, max_locks=4096):
+    # Transaction-level Postgres advisory locks on "namespace:name", for rows
+    # that no unique constraint protects. Callers lock only what they are about
+    # to create, then look it up again, since another transaction holding the
+    # lock may have committed it while we waited
+    # Keys are 64-bit hashes, taken in sorted order in one statement. Past
+    # max_locks names they are folded into max_locks keys, since every advisory
+    # lock takes a slot in the server's shared lock table until we commit
+    keys = set([advisory_key("%s:%s" % (namespace, name)) for name in names])
+    if len(keys) > max_locks:
+        keys = set([advisory_key("%s:%d" % (namespace, key % max_locks)) for key in keys])
+    if keys:
+        with connection.cursor() as cursor:
+            # unnest hands the keys back in array order
+            cursor.execute("SELECT pg_advisory_xact_lock(key) FROM unnest(%s::bigint[]) AS key", [sorted(keys)])
+
+def advisory_key(name):
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "big", signed=True)
+
+def bulk_create_polymorphic(model, objs, batch_size=None):
+    # Django can't bulk_create multi-table inherited models, which is every
+    # Value and Data subclass. So we bulk_create the rows of the root table
+    # (Postgres hands back their pks) and then insert each child table's rows
+    # straight through the manager, which is what Model.save() does one at a time
+    objs = list(objs)
+    if not objs:
+        return objs
+    chain = list(reversed(model._meta.get_parent_list())) + [model]
+    root = chain[0]
+    ctype = ContentType.objects.get_for_model(model, for_concrete_model=False)
+    root_fields = [f for f in root._meta.local_concrete_fields if not f.primary_key]
+    for obj in objs:
+        if hasattr(obj, "polymorphic_ctype_id") and obj.polymorphic_ctype_id is None:
+            obj.polymorphic_ctype_id = ctype.pk
+    parents = root._base_manager.bulk_create([root(**{f.attname: getattr(obj, f.attname) for f in root_fields}) for obj in objs],
+                                             batch_size=batch_size)
+    for obj, parent in zip(objs, parents):
+        for mdl in chain:
+            setattr(obj, mdl._meta.pk.attname, parent.pk)
+        obj._state.adding = False
+    batch_size = batch_size if batch_size else len(objs)
+    for mdl in chain[1:]:
+        for start in range(0, len(objs), batch_size):
+            mdl._base_manager._insert(objs[start:start+batch_size], fields=mdl._meta.local_concrete_fields)
+    return objs
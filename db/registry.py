@@ -0,0 +1,62 @@
+#Constant-time lookups of the Object, Value and Data subclasses
+# get_object_types, get_value_types and get_data_types used to walk
+# __subclasses__() on every call, and they sit in the inner loops of ingest
+# (Value.create, DataSignature.get, infer_type). DbConfig.ready builds one
+# TypeRegistry per base class instead, keyed on every name a type answers to
+from django.contrib.contenttypes.models import ContentType
+
+class TypeRegistry:
+    def __init__(self, types, keys):
+        # types are kept in the order given, keys(Type) lists the names that Type answers to
+        self.types = list(types)
+        self.names = {}
+        for Type in self.types:
+            for key in keys(Type):
+                # First one registered wins, same as the old linear scans
+                self.names.setdefault(key.lower(), Type)
+        self._ctypes = None
+
+    def __iter__(self):
+        return iter(self.types)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __contains__(self, name):
+        return name.lower() in self.names
+
+    def get(self, name, default=None):
+        return self.names.get(name.lower(), default)
+
+    def subclasses_of(self, cls):
+        return [Type for Type in self.types if issubclass(Type, cls) and (Type is not cls)]
+
+    def ctype_ids(self):
+        # ContentTypes live in the database, which may not exist yet when the
+        # app loads (e.g., during migrate), so these are fetched on first use
+        if self._ctypes is None:
+            ctypes = ContentType.objects.get_for_models(*self.types)
+            self._ctypes = {ctype.pk: Type for Type, ctype in ctypes.items()}
+        return self._ctypes
+
+    def from_ctype(self, ctype, default=None):
+        ctype_id = ctype.pk if isinstance(ctype, ContentType) else int(ctype)
+        return self.ctype_ids().get(ctype_id, default)
+
+# One TypeRegistry per base class, built by DbConfig.ready once every model is
+# loaded, or on first use if something asks before that
+_registries = {}
+
+def registry_for(base, types, keys):
+    # types() lists the classes to register, only called the first time
+    if base not in _registries:
+        _registries[base] = TypeRegistry(types(), keys)
+    return _registries[base]
+
+def all_subclasses(cls):
+    # Depth first, in the order the classes were defined
+    found = []
+    for sc in cls.__subclasses__():
+        found.append(sc)
+        found.extend(all_subclasses(sc))
+    return found
@@ -21,6 +21,7 @@ from .models.sample import Sample
 from .models.feature import Feature
 from .models.step import Step
 from .models.file import UploadFile
+from .ingest import BulkIngester
 
 def scalar_constructor(loader, node):
     value = loader.construct_scalar(node)
@@ -49,13 +50,18 @@ def infer_spreadsheet_type(spreadsheet_file_or_path):
             continue
     return None
 
-def ingest_spreadsheet(spreadsheet_file_or_path, user, result):
+def ingest_spreadsheet(spreadsheet_file_or_path, user, result, bulk=True, upload_file=None):
+    # With an upload_file, the ingest commits in batches and can resume from its last checkpoint
     print("Ingesting spreadsheet")
     spreadsheetformat = infer_spreadsheet_type(spreadsheet_file_or_path)
     if spreadsheetformat == None:
         raise ValueError("Unknown Sheet Type, data not scraped")
     print("Guessed format as %s" % (spreadsheetformat,))
     spreadsheetiterator = SpreadsheetIterator(spreadsheet_file_or_path, spreadsheetformat, result)
+    if bulk:
+        BulkIngester(upload_file=upload_file).ingest(spreadsheetiterator)
+        return spreadsheetiterator.filename
+    # Per-record fallback
 
     objects = {Obj.plural_name: {} for Obj in Object.get_object_types()}
     # Create
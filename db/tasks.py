@@ -4,8 +4,10 @@
 from __future__ import absolute_import, unicode_literals
 import zipfile
 import time
+import datetime
 from django.template import loader
 from celery import shared_task
+from celery.exceptions import Retry
 from django.db import models, transaction
 from django.apps import apps
 
@@ -21,8 +23,11 @@ import re
 ############### For Testing, delete later.
 import time
 #########################################
-@shared_task
-def react_to_file(upload_file_id, **kwargs):
+# Ingests checkpoint against their UploadFile, so a failed attempt is retried and
+# picks up from its last committed batch. Messages are only acknowledged once the
+# task finishes, so an upload whose worker died is redelivered and resumes the same way
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=3, default_retry_delay=60)
+def react_to_file(self, upload_file_id, **kwargs):
     #something weird happens sometimes in which uploading a file doens't work.
     #it throws an ID not found error. Trying again and changing nothing seems to work
     #So, make it try twice, then throw an error if it still doesn't work.
@@ -57,11 +62,16 @@ def react_to_file(upload_file_id, **kwargs):
                 status, result = process_qiime_artifact(upfile, analysis_pk=kwargs["analysis_pk"])
             except Exception as e:
                 print(e)
+                retry_upload(self, e)
 
         elif from_form == "S":
             mail.title="The spreadsheet you uploaded "
             print("Processing spreadsheet ...")
-            status = process_spreadsheet(upfile, kwargs["analysis_pk"])
+            try:
+                status = process_spreadsheet(upfile, kwargs["analysis_pk"])
+            except Exception as e:
+                retry_upload(self, e)
+                raise
             print(status)
 
         #Simple Sample
@@ -114,6 +124,8 @@ def react_to_file(upload_file_id, **kwargs):
             errorMessage = UploadMessage(file=upfile, error_message="Upload failure.")
             errorMessage.save()
 
+    except Retry:
+        raise
     except Exception as e:
         mail.title += "failed."
         mail.message = "Your file upload failed. The system gave the following error: "
@@ -128,6 +140,13 @@ def react_to_file(upload_file_id, **kwargs):
         errorMessage.save()
 
 
+def retry_upload(task, e):
+    # Retries react_to_file until it runs out of attempts, after which the
+    # caller goes on to report the upload as failed
+    if task.request.retries < task.max_retries:
+        print("Retrying upload, attempt %d of %d" % (task.request.retries + 1, task.max_retries))
+        raise task.retry(exc=e)
+
 @shared_task
 def process_qiime_artifact(upfile, analysis_pk):
     infile = upfile.upload_file._get_file().open()
@@ -135,7 +154,9 @@ def process_qiime_artifact(upfile, analysis_pk):
     lgr = upfile.logfile.get_logger()
     start_time = time.time()
     analysis = Analysis.objects.get(pk=analysis_pk)
-    result_uuid = ingest_artifact(infile, analysis)
+    # Checkpointed against upfile, so retrying this task picks up where it stopped
+    # Celery runs these in parallel (see ingest_artifact_directory), hence concurrent
+    result_uuid = ingest_artifact(infile, analysis, concurrent=True, upload_file=upfile)
     res = Result.get(name=result_uuid)
     fileval = File.get_or_create(name="uploaded_artifact", data=upfile,
                                  data_type="uploadfile", results=res)
@@ -150,6 +171,13 @@ def process_spreadsheet(upfile, analysis_pk):
     infile = upfile.upload_file.name #This ought to be the path to the spreadsheet on disk...
     analysis = Analysis.objects.get(pk=analysis_pk)
     user = upfile.userprofile.user
+    if upfile.ingest_phase:
+        # Resuming a checkpointed ingest, so reuse the Result it was going into
+        UploadFileDatum = apps.get_model("db.UploadFileDatum")
+        res = Result.objects.filter(values__data__in=UploadFileDatum.objects.filter(value=upfile)).first()
+        if res is not None:
+            ingest_spreadsheet(infile, user, res, upload_file=upfile)
+            return "Success"
     upload_time = datetime.datetime.now().strftime("%d_%b_%Y_%H%-M-%S")
     result_name = "Spreadsheet Upload by %s on %s" % (user.username, upload_time)
     counter = 1
@@ -160,7 +188,7 @@ def process_spreadsheet(upfile, analysis_pk):
                                      analysis = analysis)
     File.get_or_create(name="uploaded_spreadsheet", data=upfile,
                        data_type="uploadfile", results=res)
-    ingest_spreadsheet(infile, user, res.get())
+    ingest_spreadsheet(infile, user, res.get(), upload_file=upfile)
     return "Success"
 
 @shared_task
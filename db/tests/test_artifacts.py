@@ -0,0 +1,15 @@
+import io
+
+from django.test import SimpleTestCase
+
+from db.artifacts import iter_fasta
+
+
+class IterFastaTestCase(SimpleTestCase):
+    def test_multiline_and_blank_lines(self):
+        fasta = io.BytesIO(b">seq1 first\nACGT\nACG\n\n>seq2\n\nTT\nGG\n\n\n>seq3\nA\n")
+        self.assertEqual(list(iter_fasta(fasta)),
+                         [("seq1 first", "ACGTACG"), ("seq2", "TTGG"), ("seq3", "A")])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_fasta(io.BytesIO(b"\n\n"))), [])
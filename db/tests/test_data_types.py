@@ -0,0 +1,18 @@
+from django.test import SimpleTestCase
+import numpy as np
+from scipy.spatial.distance import squareform
+
+from db.models import *
+
+
+class DistanceMatrixDatumTestCase(SimpleTestCase):
+    def test_condensed_indexing(self):
+        names = ["a", "b", "c", "d", "e"]
+        rng = np.random.default_rng(0)
+        full = rng.random((len(names), len(names)))
+        full = full + full.T
+        np.fill_diagonal(full, 0)
+        datum = DistanceMatrixDatum(value=squareform(full).tolist(), names=names)
+        for i, name_a in enumerate(names):
+            for j, name_b in enumerate(names):
+                self.assertAlmostEqual(datum.distance(name_a, name_b), full[i, j])
@@ -0,0 +1,39 @@
+from django.test import TestCase
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from db.artifacts import FeatureTable
+from db.ingest import BulkIngester
+from db.models import *
+
+
+class LinkMatrixTestCase(TestCase):
+    def setUp(self):
+        self.samples = {name: Sample.objects.create(name=name) for name in ["s0", "s1", "s2"]}
+        self.features = {name: Feature.objects.create(name=name) for name in ["f0", "f1", "f2"]}
+        # Linked before the ingest, so linking it again must be skipped
+        self.samples["s0"].features.add(self.features["f0"])
+
+    def observations(self, matrix, samples, features):
+        # A FeatureTable without an artifact behind it: rows are Features, columns Samples
+        table = FeatureTable.__new__(FeatureTable)
+        table.matrix, table.samples, table.features = matrix, samples, features
+        return table.observations()
+
+    def linked(self):
+        return set(Sample.features.through.objects.values_list("sample__name", "feature__name"))
+
+    def test_link_matrix(self):
+        # f3 and s9 were never created, so whatever they're observed with is dropped,
+        # and an explicit zero count isn't an observation
+        rows = np.array([0, 1, 2, 3, 2, 0])
+        cols = np.array([0, 0, 1, 1, 3, 2])
+        counts = np.array([5, 2, 0, 7, 1, 4])
+        matrix = coo_matrix((counts, (rows, cols)), shape=(4, 4))
+        observations = self.observations(matrix, ["s0", "s1", "s2", "s9"], ["f0", "f1", "f2", "f3"])
+        self.assertEqual(observations[:2], (Sample, "features"))
+        BulkIngester().link_matrix(*observations)
+        self.assertEqual(self.linked(), set([("s0", "f0"), ("s0", "f1"), ("s2", "f0")]))
+        # Ingesting the same table again changes nothing
+        BulkIngester().link_matrix(*observations)
+        self.assertEqual(Sample.features.through.objects.count(), 3)
@@ -0,0 +1,33 @@
+from django.test import TestCase
+from db.models import *
+
+
+class LineageTestCase(TestCase):
+    # A small graph with a diamond, a cycle and an isolated node:
+    #   a <- b <- d,  a <- c <- d,  d <- e <- f <- d,  g
+    edges = [("b", "a"), ("c", "a"), ("d", "b"), ("d", "c"),
+             ("e", "d"), ("f", "e"), ("d", "f")]
+
+    def setUp(self):
+        self.procs = {name: Process.objects.create(name="lineage_%s" % (name,)) for name in "abcdefg"}
+        for down, up in self.edges:
+            self.procs[down].upstream.add(self.procs[up])
+        Process.rebuild_closure()
+
+    def lineage_names(self, names, downstream, strategy):
+        objs = Process.objects.filter(pk__in=[self.procs[x].pk for x in names])
+        found = Process.lineage(objs, downstream=downstream, strategy=strategy)
+        return set([name for name, proc in self.procs.items() if proc in found])
+
+    def test_strategies_agree(self):
+        for names in ["a", "b", "d", "e", "g", "ab", "bd", "ef", "abcdefg"]:
+            for downstream in [False, True]:
+                recursive = self.lineage_names(names, downstream, "recursive")
+                materialized = self.lineage_names(names, downstream, "materialized")
+                self.assertEqual(recursive, materialized, "%s, downstream=%s" % (names, downstream))
+                self.assertFalse(recursive & set(names))
+
+    def test_upstream(self):
+        self.assertEqual(self.lineage_names("d", False, "materialized"), set("abcef"))
+        self.assertEqual(self.lineage_names("a", True, "materialized"), set("bcdef"))
+        self.assertEqual(self.lineage_names("g", False, "recursive"), set())
@@ -0,0 +1,26 @@
+from django.test import SimpleTestCase
+import pandas as pd
+
+from db.models import *
+
+
+class KwargsPlanTestCase(SimpleTestCase):
+    def test_match(self):
+        plan = Object.kwargs_plan()
+        entries = [plan.entries[idx] for idx in plan.match("sample_name.3")]
+        self.assertIn((Sample, "name"), [(base_type, field) for base_type, field, m2m, required, relational in entries])
+        self.assertEqual(plan.match("not_a_heading"), [])
+
+
+class PivotWideTestCase(SimpleTestCase):
+    def test_first_value_wins(self):
+        df = pd.DataFrame({"sample": ["s1", "s1", "s2", "s1", "s2"],
+                           "name": ["depth", "depth", "depth", "site", "depth"],
+                           "data": [1, 2, 3, "a", 4]})
+        wide = Object.pivot_wide(df, "sample", "name", "data")
+        self.assertEqual(list(wide.index), ["s1", "s2"])
+        self.assertEqual(list(wide.columns), ["depth", "site"])
+        self.assertEqual(wide.loc["s1", "depth"], 1)
+        self.assertEqual(wide.loc["s2", "depth"], 3)
+        self.assertEqual(wide.loc["s1", "site"], "a")
+        self.assertTrue(pd.isna(wide.loc["s2", "site"]))
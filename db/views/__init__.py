@@ -25,4 +25,5 @@ from .upload_views import *
 from .mail_views import *
 from .download_views import *
 from .generic_views import HomePageView, no_auth_view
+from .provenance_views import provenance_json_view
 from .autocomplete_views import *
@@ -112,6 +112,8 @@ class CountMatrixAutocomplete(autocomplete.Select2QuerySetView):
         taxonomy_result = self.forwarded.get("taxonomy_result", None)
         self.matrix_ct = ContentType.objects.get_for_model(Matrix)
         qs = Result.objects.filter(values__signature__value_type=self.matrix_ct)
+        if not self.forwarded.get("distance_matrices", False):
+            qs = qs.filter(values__data__in=COOMatrixDatum.objects.all())
         if self.q:
             qs = qs.filter(name__icontains=self.q)
         if taxonomy_result:
@@ -0,0 +1,22 @@
+# ----------------------------------------------------------------------------
+# path: quorem/db/views/provenance_views.py
+# description: This file contains views that serve provenance graphs
+#              incrementally, as JSON, for clients to expand on demand.
+# ----------------------------------------------------------------------------
+
+from django.http import JsonResponse, Http404
+
+from ..models.object import Object
+
+def provenance_json_view(request, object_type, object_id):
+    # A node's immediate upstream and downstream neighbours and their summary counts
+    # e.g. /provenance/result/12/
+    try:
+        Obj = Object.get_object_types(type_name=object_type)
+    except ValueError:
+        raise Http404("Unknown object type '%s'" % (object_type,))
+    try:
+        obj = Obj.objects.get(pk=object_id)
+    except Obj.DoesNotExist:
+        raise Http404("No %s with id %d" % (Obj.base_name, object_id))
+    return JsonResponse(obj.provenance_neighbours())
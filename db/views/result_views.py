@@ -26,11 +26,10 @@ class ResultDetailView(DetailView):
         context['samples_html'] = mark_safe(obj.html_samples())
         #context['features_html'] = mark_safe(obj.html_features())
         if obj.has_value('qiime2_type'):
-            context['provenance_graph'] = mark_safe(obj.simple_provenance_graph().pipe().decode().replace("<svg ", "<svg id=\"provenancegraph\" class=\"img-fluid\" ").replace("\n",""))
-            stream_graph = obj.get_stream_graph()
+            context['provenance_graph'] = mark_safe(obj.simple_provenance_svg().replace("<svg ", "<svg id=\"provenancegraph\" class=\"img-fluid\" ").replace("\n",""))
             try:
-                stream_graph = stream_graph.pipe()
-                context['stream_graph'] = mark_safe(stream_graph.decode().replace("<svg ", "<svg id=\"streamgraph\" class=\"img-fluid\" ").replace("\n", ""))
+                stream_graph = obj.stream_graph_svg()
+                context['stream_graph'] = mark_safe(stream_graph.replace("<svg ", "<svg id=\"streamgraph\" class=\"img-fluid\" ").replace("\n", ""))
             except:
                 print("Stream graph failed to load")
         #context['values_html'] = mark_safe(obj.html_values())
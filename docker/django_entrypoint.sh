@@ -1,6 +1,7 @@
 #!/bin/bash
 conda run -n quorem python manage.py makemigrations
 conda run -n quorem python manage.py migrate
+conda run -n quorem python manage.py hashdata
 conda run -n quorem python manage.py initialize
 conda run -n quorem python manage.py createsuperuser --noinput --email ${DJANGO_SUPERUSER_EMAIL}
 conda run -n quorem python manage.py collectstatic --noinput
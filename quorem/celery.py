@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quorem.settings')
@@ -16,6 +17,15 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
+@worker_process_init.connect
+def warm_caches(**kwargs):
+    # Every ingest looks DataSignatures up, so load them before the first task does
+    from db.models import DataSignature
+    try:
+        DataSignature.cached_signatures()
+    except Exception:
+        pass # e.g., not migrated yet, the first lookup will load them instead
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
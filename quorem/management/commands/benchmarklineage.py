@@ -0,0 +1,52 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from db.models.object import Object
+class Command(BaseCommand):
+    help = "Compare the materialized and recursive lineage strategies on the provenance in this database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', nargs=1, type=int, default=[50], required=False, help="Objects of each type to time")
+        parser.add_argument('--repeats', nargs=1, type=int, default=[3], required=False)
+        parser.add_argument('--seed', nargs=1, type=int, default=[0], required=False)
+
+    def handle(self, *args, **options):
+        n_samples = options['samples'][0]
+        repeats = options['repeats'][0]
+        rng = random.Random(options['seed'][0])
+        strategies = ["materialized", "recursive"]
+        for Obj in Object.get_object_types():
+            if not Obj.has_upstream:
+                continue
+            pks = list(Obj.objects.filter(upstream__isnull=False).values_list("pk", flat=True).distinct())
+            if not pks:
+                self.stdout.write("%s: no upstream links, skipping" % (Obj.plural_name.capitalize(),))
+                continue
+            pks = rng.sample(pks, min(n_samples, len(pks)))
+            timings = {(strategy, downstream): [] for strategy in strategies for downstream in [False, True]}
+            mismatches = 0
+            sizes = []
+            for pk in pks:
+                objs = Obj.objects.filter(pk=pk)
+                for downstream in [False, True]:
+                    found = {}
+                    for strategy in strategies:
+                        best = None
+                        for i in range(repeats):
+                            start_time = time.perf_counter()
+                            found[strategy] = set(Obj.lineage(objs, downstream=downstream, strategy=strategy).values_list("pk", flat=True))
+                            elapsed = time.perf_counter() - start_time
+                            best = elapsed if best is None else min(best, elapsed)
+                        timings[(strategy, downstream)].append(best)
+                    if found["materialized"] != found["recursive"]:
+                        mismatches += 1
+                    if not downstream:
+                        sizes.append(len(found["recursive"]))
+            self.stdout.write("%s: %d objects, %.1f ancestors on average (max %d)" % (Obj.plural_name.capitalize(), len(pks), sum(sizes) / len(sizes), max(sizes)))
+            for (strategy, downstream), times in timings.items():
+                times = sorted(times)
+                self.stdout.write("  %-12s %-10s mean %.2fms, median %.2fms, max %.2fms" % (strategy, "downstream" if downstream else "upstream",
+                                                                                          1000 * sum(times) / len(times), 1000 * times[len(times)//2], 1000 * times[-1]))
+            if mismatches:
+                self.stderr.write("  %d lookups disagree between strategies, the all_upstream cache may be stale (see Object.rebuild_closure)" % (mismatches,))
@@ -0,0 +1,8 @@
+from django.core.management.base import BaseCommand, CommandError
+from db.models import Data
+class Command(BaseCommand):
+    help = "Fill in the value hash of any text Data stored before QUOREM hashed it, merging duplicate copies first. Run once after upgrading an existing database; running it again does nothing"
+
+    def handle(self, *args, **options):
+        print("Merging and hashing any Data stored without a value hash")
+        Data.fill_value_hashes()
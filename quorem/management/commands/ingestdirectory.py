@@ -0,0 +1,33 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from db.models import Analysis
+from db.artifacts import ingest_artifacts
+class Command(BaseCommand):
+    help = "Ingest every artifact in a directory in parallel through the shell, and report throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', nargs=1, type=str, default=None, required=True)
+        parser.add_argument('--analysispk', nargs=1, type=int, default=None, required=True)
+        parser.add_argument('--workers', nargs=1, type=int, default=[4], required=False)
+
+    def handle(self, *args, **options):
+        directory = options['directory'][0]
+        workers = options['workers'][0]
+        analysis = Analysis.objects.get(pk=options['analysispk'][0])
+        if not os.path.isdir(directory):
+            raise CommandError("%s is not a directory" % (directory,))
+        paths = [os.path.join(directory, x) for x in sorted(os.listdir(directory)) if x.endswith(".qza") or x.endswith(".qzv")]
+        total_bytes = sum([os.path.getsize(x) for x in paths])
+        start_time = time.time()
+        finished = ingest_artifacts(paths, analysis, workers=workers)
+        elapsed = time.time() - start_time
+        failed = [(path, error) for path, uuid, seconds, error in finished if error is not None]
+        for path, error in failed:
+            self.stderr.write("Failed to ingest %s: %s" % (path, error))
+        worker_time = sum([seconds for path, uuid, seconds, error in finished])
+        self.stdout.write("Ingested %d of %d artifacts (%.1f MB) in %.1fs with %d workers" % (len(finished) - len(failed), len(paths), total_bytes / 1e6, elapsed, workers))
+        if elapsed > 0:
+            self.stdout.write("Throughput: %.2f artifacts/s, %.2f MB/s" % (len(paths) / elapsed, total_bytes / 1e6 / elapsed))
+            self.stdout.write("Speedup over the summed per-artifact time: %.2fx" % (worker_time / elapsed,))
@@ -3,6 +3,9 @@ from db.artifacts import mine_qiime2
 class Command(BaseCommand):
     help = "Initialize an empty QUOREM database"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--refresh', action='store_true', help="Rebuild the QIIME2 plugin snapshot even if one exists for these plugin versions")
+
     def handle(self, *args, **options):
         print("Fetching Step objects from QIIME2 SDK")
-        mine_qiime2()
+        mine_qiime2(refresh=options['refresh'])
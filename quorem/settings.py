@@ -94,6 +94,24 @@ CELERY_RESULT_BACKEND = 'redis://%s:6379' % (CELERY_HOSTNAME,)
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# Uploads are acknowledged late (see db.tasks.react_to_file), so workers take one
+# at a time, and Redis waits long enough for a big ingest before redelivering it
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 12*60*60}
+
+# Shared by the web and celery processes, so that e.g. an ingest can invalidate cached provenance graphs
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://%s:6379/1' % (CELERY_HOSTNAME,),
+    }
+}
+
+#### Provenance lineage
+# "materialized": ancestors/descendants come from the all_upstream cache, kept up to date on every upstream link
+# "recursive": they're computed from the direct upstream links with a recursive query, and the cache isn't maintained
+# Switching back to "materialized" needs the cache rebuilt first (Object.rebuild_closure() for each type)
+LINEAGE_STRATEGY = os.environ.get('QUOREM_LINEAGE_STRATEGY', 'materialized')
 
 ####CORS
 CORS_ORIGIN_WHITELIST = [
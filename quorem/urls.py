@@ -144,6 +144,9 @@ urlpatterns += [
     path('plot/table/', TablePlotView.as_view(), name='plot-table'),
     path('plot/tree/', TreePlotView.as_view(), name='plot-tree'),
 
+    #### provenance explorer routing
+    path('provenance/<str:object_type>/<int:object_id>/', login_required(provenance_json_view), name='provenance_json'),
+
     ## Autocomplete Routing
     # See below for generic autcomplete magic
     re_path(r'^value-autocomplete/$',